@@ -54,6 +54,10 @@ e.g.::
           'religion': MormConvString()
           }
 
+Setting 'objcls' to MormRow instead creates objects with slots for exactly the
+selected columns, which use less memory than MormObject instances but do not
+accept other attributes.
+
 
 Insert (C)
 ----------
@@ -64,6 +68,20 @@ Insert some new row in a table::
                    lastname=u'Sousa',
                    religion='candombl')
 
+Many rows can be inserted at once, for the cost of a single statement::
+
+  TestTable.insert_many(connection,
+                        [dict(firstname=u'Adriana', lastname=u'Sousa'),
+                         dict(firstname=u'Yanni', lastname=u'Caluma')])
+
+If your code inserts rows one at a time, a MormInsertBuffer can collect them
+and send them in batches::
+
+  buf = MormInsertBuffer(connection)
+  for firstname, lastname in names:
+      buf.insert(TestTable, firstname=firstname, lastname=lastname)
+  buf.commit()
+
 Select (R)
 ----------
 Add a where condition, and select some columns::
@@ -107,10 +125,74 @@ See doc/ in distribution for additional notes.
 
 __author__ = 'Martin Blais <blais@furius.ca>'
 
+# stdlib imports
+import re
+import threading
+from binascii import hexlify
+from collections import deque, OrderedDict
+from itertools import chain
+from itertools import count as itercount
+import weakref
+try:
+    from itertools import imap
+except ImportError:
+    imap = map # Python 3
+
 
 __all__ = ['MormTable', 'MormObject', 'MormError',
            'MormConv', 'MormConvUnicode', 'MormConvString',
-           'MormDecoder', 'MormEncoder']
+           'MormDecoder', 'MormEncoder', 'MormInsertBuffer', 'MormRow']
+
+
+# Use psycopg2's multi-VALUES inserts for multiple rows if it is available, it
+# saves most of the round-trips that the DBAPI's executemany() incurs.
+try:
+    from psycopg2.extensions import cursor as pgcursor
+    from psycopg2.extras import execute_values
+    # Adapters that COPY has to render itself.
+    from psycopg2.extensions import Binary as pgbinary
+    from psycopg2.extras import Json as pgjson
+except ImportError:
+    pgcursor = execute_values = pgbinary = pgjson = None
+
+# NumPy is only needed for selecting into arrays.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2: the generated SQL statements are simply not cached.
+    def lru_cache(maxsize=128):
+        return lambda fun: fun
+
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2 has it as a builtin.
+
+try:
+    unicode
+except NameError:
+    unicode = str # Python 3
+
+_untyped_types = (str, unicode, type(None))
+"""Types of the values that the DBAPI renders as SQL literals of unknown
+type, typed by their context."""
+if pgjson is not None:
+    _untyped_types += (pgjson,)
+
+try:
+    _binary_types = (bytes, bytearray, memoryview, buffer)
+except NameError:
+    _binary_types = (bytes, bytearray, memoryview) # Python 3
+
+
+
+_re_nolimit = re.compile(r'\b(LIMIT|FOR)\b', re.I)
+"""Regexp for conditions that select_one() should not add a LIMIT to."""
 
 
 
@@ -128,6 +210,26 @@ class MormObject(object):
     """
 
 
+class MormRow(object):
+    """
+    Base class for decoded rows that store their values in slots.  When this
+    is used as the class of objects to create, the decoder creates instances
+    of a subclass with a slot for each of its columns, shared by all the
+    decoders of the same columns.  If some of the column names are not valid
+    identifiers (e.g. '?column?' or 'count(*)'), MormObject is used instead.
+    """
+    __slots__ = ()
+
+_re_identifier = re.compile('[a-zA-Z_][a-zA-Z0-9_]*$')
+
+@lru_cache(maxsize=256)
+def _row_class(names):
+    for name in names:
+        if not _re_identifier.match(name):
+            return MormObject
+    return type('MormRow', (MormRow,), {'__slots__': names})
+
+
 class MormTable(object):
     """
     Class for declarations that relate to a table.
@@ -151,6 +253,16 @@ class MormTable(object):
     converters = {}
     "Custom converter map for columns"
 
+    use_prepared = False
+    """Set this to use server-side prepared statements (PostgreSQL PREPARE and
+    EXECUTE) for inserts and for the selects of select(), select_one() and
+    get(), e.g. for repeated point lookups.  Statements with list or tuple
+    arguments, e.g. for 'WHERE id IN %s', are executed without preparing
+    them, and so are those that the server fails to prepare.  At most 64
+    statements are kept prepared on each connection (see _prepared_max), the
+    least recently used ones being deallocated, so conditions built on the fly
+    do not accumulate."""
+
     #---------------------------------------------------------------------------
     # Misc methods.
 
@@ -173,8 +285,16 @@ class MormTable(object):
         be either a sequence of column names, or a cursor from which we will
         fetch the description.  You will still have to pass in the cursor for
         decoding later on.
+
+        Decoders are shared between the calls for the same columns, so you
+        should not modify the returned decoder.
         """
-        return MormDecoder(cls, desc)
+        if isinstance(desc, (tuple, list)):
+            colnames = tuple(desc)
+        else:
+            assert desc is not None
+            colnames = tuple(x[0] for x in desc.description)
+        return _shared_decoder(cls, colnames)
 
     #---------------------------------------------------------------------------
     # Methods that only read from the connection
@@ -195,22 +315,43 @@ class MormTable(object):
 
     @classmethod
     def select(cls, conn, cond=None, args=None, cols=None,
-               objcls=None, distinct=None):
+               objcls=None, distinct=None, stream=False, prefetch=None):
         """
         Convenience method that executes a select and returns an iterator for
         the results, wrapped in objects with attributes
+
+        If 'stream' is true, the select runs in a server-side (named) cursor,
+        so that the rows are fetched in batches as they are iterated over
+        instead of all being transferred at once.  This is useful for very
+        large results.  Note that the length of the iterator is then only the
+        number of rows fetched so far.
+
+        'prefetch' is the number of rows fetched from the cursor at once,
+        MormDecoderIterator.batchsize by default.  With 'stream', this is the
+        number of rows transferred from the server in each round-trip.
         """
         assert conn is not None
 
         # Perform the select.
-        cursor = MormDecoder.do_select(conn, (cls,), cols,
-                                       cond, args, distinct)
+        if stream:
+            cursor = MormDecoder.do_select(conn, (cls,), cols,
+                                           cond, args, distinct,
+                                           cursor_name=_cursor_name())
+        else:
+            cursor = MormDecoder.do_select(conn, (cls,), cols,
+                                           cond, args, distinct,
+                                           prepared=cls.use_prepared)
+
+        # A server-side cursor only gets a description after a first fetch.
+        rows = None
+        if stream:
+            rows = cursor.fetchmany(prefetch or MormDecoderIterator.batchsize)
 
         # Create a decoder using the description on the cursor.
-        dec = MormDecoder(cls, cursor)
+        dec = cls.decoder(cursor)
 
         # Return an iterator over the cursor.
-        return dec.iter(cursor, objcls)
+        return MormDecoderIterator(dec, cursor, objcls, rows, prefetch)
 
     @classmethod
     def select_all(cls, conn, cond=None, args=None, cols=None,
@@ -226,14 +367,35 @@ class MormTable(object):
                                        cond, args, distinct)
 
         # Create a decoder using the description on the cursor.
-        dec = MormDecoder(cls, cursor)
+        dec = cls.decoder(cursor)
 
         # Fetch all the objects from the cursor and decode them.
-        objects = []
-        for row in cursor.fetchall():
-            objects.append(dec.decode(row, objcls=objcls))
+        return dec.decode_all(cursor.fetchall(), objcls)
 
-        return objects
+    @classmethod
+    def select_ndarray(cls, conn, cond=None, args=None, cols=None,
+                       distinct=None):
+        """
+        Convenience method that executes a select and returns all the results
+        in a NumPy record array, with one field per column.  No converters are
+        applied and no objects are created, which makes this suitable for
+        large selects of numeric columns.  This requires NumPy.
+        """
+        if numpy is None:
+            raise MormError("NumPy is required to select into an array.")
+
+        assert conn is not None
+
+        # Perform the select.
+        cursor = MormDecoder.do_select(conn, (cls,), cols,
+                                       cond, args, distinct)
+
+        # Let NumPy infer the types of the fields from the values.
+        names = [str(x[0].split('.')[-1]) for x in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            return numpy.recarray((0,), dtype=[(x, object) for x in names])
+        return numpy.rec.fromrecords(rows, names=names)
 
     @classmethod
     def select_one(cls, conn, cond=None, args=None, cols=None,
@@ -242,34 +404,40 @@ class MormTable(object):
         Convenience method that executes a select the first object that matches,
         and that also checks that there is a single object that matches.
         """
+        # Two rows are enough to find out if more than one row matches.  Leave
+        # the condition alone if the LIMIT cannot simply be appended to it.
+        if cond is None:
+            cond = ''
+        if not _re_nolimit.search(cond):
+            cond += ' LIMIT 2'
+
         it = cls.select(conn, cond, args, cols, objcls, distinct)
-        if len(it) > 1:
-            raise MormError("select_one() matches more than one row.")
         try:
-            o = it.next()
+            o = next(it)
         except StopIteration:
-            o = None
-        return o
+            return None
+        try:
+            next(it)
+        except StopIteration:
+            return o
+        raise MormError("select_one() matches more than one row.")
 
     @classmethod
     def get(cls, conn, cols=None, default=NODEF, **constraints):
         """
         Convenience method that gets a single object by its primary key.
         """
-        cons, args = [], []
-        for colname, colvalue in list(constraints.items()):
-            cons.append('%s = %%s' % colname)
-            args.append(colvalue)
-
-        cond = 'WHERE ' + ' AND '.join(cons)
+        # Note: keys() and values() of an unmodified dict are in the same order.
+        cond = _where_sql(tuple(constraints.keys()))
+        args = tuple(constraints.values())
         it = cls.select(conn, cond, args, cols)
         try:
-            if len(it) == 0:
-                if default is NODEF:
-                    raise MormError("Object not found (%s)." % str(constraints))
-                else:
-                    return default
-            return it.next()
+            return next(it)
+        except StopIteration:
+            if default is NODEF:
+                raise MormError("Object not found (%s)." % str(constraints))
+            else:
+                return default
         finally:
             del it
 
@@ -313,7 +481,7 @@ class MormTable(object):
         cursor.execute(query, args)
         
         # Get a decoder with the cursor results.
-        dec = MormDecoder(cls, cursor)
+        dec = cls.decoder(cursor)
 
         # Return an iterator over the cursor.
         return dec.iter(cursor, objcls)
@@ -327,6 +495,104 @@ class MormTable(object):
         enc = cls.encoder(**fields)
         return enc.insert(conn, cond, args)
 
+    @classmethod
+    def insert_many(cls, conn, rows, page_size=None):
+        """
+        Convenience method that inserts a sequence of rows, each given as a
+        dict of column values, using a single statement for all of them.  All
+        the rows must have the same columns.  Returns the cursor, or None if
+        there were no rows to insert.  Note: this does not commit the
+        connection.
+
+        With psycopg2, the rows are sent in multi-row INSERT statements of
+        'page_size' rows each; by default, up to 1000 rows, and fewer for wide
+        rows, to keep each statement under about 65535 values.  The values are
+        formatted into the statements on the client, so this only bounds the
+        size of the statements.
+        """
+        colnames, values = cls._encode_rows(rows)
+        if colnames is None:
+            return None
+        if not colnames:
+            raise MormError("Cannot insert rows without any columns.")
+        values = list(values)
+
+        # Run the query.
+        assert conn
+        cursor = conn.cursor()
+
+        if execute_values is not None and isinstance(cursor, pgcursor):
+            if page_size is None:
+                page_size = min(1000, 65535 // len(colnames))
+            sql = "INSERT INTO %s (%s) VALUES %%s" % (cls.tname(),
+                                                     ', '.join(colnames))
+            execute_values(cursor, sql, values, page_size=page_size)
+        else:
+            cursor.executemany(_insert_sql(cls.tname(), colnames, ''), values)
+
+        return cursor
+
+    @classmethod
+    def copy_from(cls, conn, rows):
+        """
+        Convenience method that inserts a sequence of rows like insert_many(),
+        but using PostgreSQL's COPY, which is much faster for large numbers of
+        rows.  The rows are converted and streamed to the database as they are
+        consumed, so 'rows' can be a generator.  The converted values are
+        rendered as text for COPY, with binary strings as bytea and lists and
+        tuples as arrays; values that cannot be rendered, e.g. dicts not
+        wrapped in psycopg2's Json, raise a MormError.  If the cursor does not
+        support COPY (psycopg2's copy_expert()), this falls back on
+        executemany().  Returns the cursor, or None if there were no rows to
+        insert.  Note: this does not commit the connection.
+        """
+        colnames, values = cls._encode_rows(rows)
+        if colnames is None:
+            return None
+
+        # Run the query.
+        assert conn
+        cursor = conn.cursor()
+
+        if hasattr(cursor, 'copy_expert'):
+            sql = "COPY %s (%s) FROM STDIN WITH CSV" % (cls.tname(),
+                                                        ', '.join(colnames))
+            cursor.copy_expert(sql, _CopyStream(imap(_csv_line, values)))
+        else:
+            cursor.executemany(_insert_sql(cls.tname(), colnames, ''),
+                               list(values))
+
+        return cursor
+
+    @classmethod
+    def _encode_rows(cls, rows):
+        """
+        Returns the column names of the given rows, given as dicts of column
+        values, and an iterator over the tuples of their converted values.  The
+        first row determines the order of the columns.  Returns (None, None) if
+        there are no rows.
+        """
+        rows = iter(rows)
+        try:
+            first = next(rows)
+        except StopIteration:
+            return None, None
+
+        colnames = tuple(first)
+        converters = [cls.converters.get(cname, None) for cname in colnames]
+
+        def encode(row):
+            if len(row) != len(colnames):
+                raise MormError("All rows must have the same columns.")
+            try:
+                return tuple((conv.from_python(row[cname]) if conv is not None
+                              else row[cname])
+                             for cname, conv in zip(colnames, converters))
+            except KeyError:
+                raise MormError("All rows must have the same columns.")
+
+        return colnames, imap(encode, chain((first,), rows))
+
     @classmethod
     def create(cls, conn, cond=None, args=None, pk='id', **fields):
         """
@@ -334,13 +600,19 @@ class MormTable(object):
         statement, and then fetches the data back from the database (because of
         defaults) and returns the new object.
 
-        Note: this assumes that the primary key is composed of a single column.
-        Note2: this does NOT commit the transaction.
+        The row is fetched back in the same statement, with INSERT ...
+        RETURNING, so 'pk' is not used anymore and is only accepted for
+        compatibility.  If no row was inserted, e.g. with a 'cond' of 'ON
+        CONFLICT DO NOTHING' or because of a trigger, None is returned.
+
+        Note: this does NOT commit the transaction.
         """
-        cls.insert(conn, cond, args, **fields)
-        pkseq = '%s_%s_seq' % (cls.table, pk)
-        seq = cls.getsequence(conn, pkseq)
-        return cls.get(conn, **{pk: seq})
+        enc = cls.encoder(**fields)
+        cursor = enc.insert_returning(conn, cond, args)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return cls.decoder(cursor).decode(row)
 
     @classmethod
     def update(cls, conn, cond=None, args=None, **fields):
@@ -351,6 +623,85 @@ class MormTable(object):
         enc = cls.encoder(**fields)
         return enc.update(conn, cond, args)
 
+    @classmethod
+    def update_many(cls, conn, updates, key='id', page_size=1000):
+        """
+        Convenience method that applies a sequence of updates, each given as a
+        (key value, dict of column values) pair, where the key value selects
+        the row to update by its 'key' column.  Consecutive updates of the same
+        columns are merged into a single statement, e.g.
+
+          UPDATE t SET a = CASE id WHEN 1 THEN 'x' WHEN 2 THEN 'y' ELSE a END
+            WHERE id IN (1, 2)
+
+        of up to 'page_size' rows each.  The result is the same as updating
+        the rows one at a time, in order.  Updates without any columns are
+        skipped.  Returns the last cursor, or None if there were no updates.
+        Note: this does not commit the connection.
+        """
+        assert conn
+        cursor = None
+        colnames, batch = None, {}
+        for keyvalue, fields in updates:
+            fields = dict(fields)
+            fields[key] = keyvalue
+            enc = cls.encoder(**fields)
+            values = dict(zip(enc.colnames, enc.colvalues))
+            keyvalue = values.pop(key)
+            if not values:
+                continue
+            names = tuple(sorted(values))
+
+            # Start a new statement for other columns or for a row that is
+            # already in the batch, to preserve the order of the updates.
+            if (names != colnames or keyvalue in batch or
+                len(batch) >= page_size):
+                if batch:
+                    cursor = cls._update_batch(conn, key, colnames, batch)
+                colnames, batch = names, {}
+            batch[keyvalue] = values
+
+        if batch:
+            cursor = cls._update_batch(conn, key, colnames, batch)
+        return cursor
+
+    @classmethod
+    def _update_batch(cls, conn, key, colnames, batch):
+        """
+        Update the rows in 'batch', a dict of key value to a dict of encoded
+        column values for 'colnames', with a single statement.
+        """
+        keys = list(batch.keys())
+        whens = ' '.join(['WHEN %s THEN %s'] * len(keys))
+
+        # A CASE whose values are all quoted strings or NULLs would be of type
+        # text; give it the type of the column with an ELSE branch that is
+        # never taken.  Other values have a type of their own, which the
+        # column may not share (e.g. a number for a text column).
+        cases = []
+        for cname in colnames:
+            for keyvalue in keys:
+                if not isinstance(batch[keyvalue][cname], _untyped_types):
+                    cases.append('%s = CASE %s %s END' % (cname, key, whens))
+                    break
+            else:
+                cases.append('%s = CASE %s %s ELSE %s END' % (cname, key,
+                                                              whens, cname))
+
+        sql = "UPDATE %s SET %s WHERE %s IN (%s)" % (
+            cls.tname(), ', '.join(cases), key, ', '.join(['%s'] * len(keys)))
+
+        args = []
+        for cname in colnames:
+            for keyvalue in keys:
+                args.append(keyvalue)
+                args.append(batch[keyvalue][cname])
+        args.extend(keys)
+
+        cursor = conn.cursor()
+        cursor.execute(sql, args)
+        return cursor
+
     @classmethod
     def delete(cls, conn, cond=None, args=None):
         """
@@ -361,17 +712,100 @@ class MormTable(object):
         if cond is None:
             cond = ''
         if args is None:
-            args = []
+            args = ()
 
         # Run the query.
         assert conn
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM %s %s" % (cls.table, cond),
-                       list(args))
+        cursor.execute("DELETE FROM %s %s" % (cls.table, cond), args)
         return cursor
 
 
 
+_cursor_ids = itercount(1)
+
+def _cursor_name():
+    """
+    Returns a new unique name for a server-side cursor.
+    """
+    return 'antiorm_cursor_%d' % next(_cursor_ids)
+
+
+def _csv_line(values):
+    """
+    Format the given values as a line of CSV for COPY, quoting all the values
+    so that NULLs (None) can be told apart from empty strings.
+    """
+    return ','.join([(('"%s"' % _copy_text(x).replace('"', '""'))
+                      if x is not None else '')
+                     for x in values]) + '\n'
+
+def _copy_text(value):
+    """
+    Return the text input representation of a value for COPY: the strings
+    as they are (unicode is encoded on Python 2, to be joined with encoded
+    strings), binary strings in the hex format of bytea, lists and tuples as
+    array literals, and other values as formatted by '%s'.  Raises a MormError
+    for the values that cannot be represented this way, e.g. dicts.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode(dbapi_encoding) # Python 2
+    if pgbinary is not None:
+        if isinstance(value, pgbinary):
+            value = value.adapted
+        elif isinstance(value, pgjson):
+            return value.dumps(value.adapted)
+    if isinstance(value, _binary_types):
+        digits = hexlify(value)
+        if not isinstance(digits, str):
+            digits = digits.decode('ascii') # Python 3
+        return '\\x' + digits
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ','.join([_copy_element(x) for x in value])
+    if isinstance(value, (dict, set)) or hasattr(value, 'getquoted'):
+        raise MormError("Cannot COPY value %r." % (value,))
+    return '%s' % value
+
+def _copy_element(value):
+    """
+    Return the representation of an element of an array literal for COPY.
+    Nested lists and tuples are the subarrays of multidimensional arrays.
+    """
+    if value is None:
+        return 'NULL'
+    text = _copy_text(value)
+    if isinstance(value, (list, tuple)):
+        return text
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+class _CopyStream(object):
+    """
+    Read-only file-like object over an iterator of strings, for COPY FROM.
+    """
+    def __init__(self, strings):
+        self.strings = iter(strings)
+        self.buf = ''
+
+    def read(self, size=-1):
+        chunks, length = [self.buf], len(self.buf)
+        while size < 0 or length < size:
+            try:
+                s = next(self.strings)
+            except StopIteration:
+                break
+            chunks.append(s)
+            length += len(s)
+        data = ''.join(chunks)
+        if size < 0:
+            self.buf = ''
+            return data
+        self.buf = data[size:]
+        return data[:size]
+
+
+
 class MormError(Exception):
     """
     Error happening in this module.
@@ -383,6 +817,14 @@ class MormConv(object):
     """
     Base class for all automated type converters.
     """
+    is_identity = False
+    """Set this to true if to_python() returns the values unchanged, so that
+    decoding can skip the converter altogether."""
+
+    identity_types = ()
+    """Types of the values that to_python() returns unchanged.  When decoding
+    many rows, a column whose values are all of these types is not converted."""
+
     def from_python(self, value):
         """
         Convert value from Python into a type suitable for insertion in a
@@ -397,6 +839,43 @@ class MormConv(object):
         """
         return value
 
+    def to_python_batch(self, values):
+        """
+        Convert a sequence of values from the database connection, e.g. all the
+        values of a column, into a list of Python values.  Override this if you
+        can convert many values faster than one at a time.
+        """
+        return list(map(self.to_python, values))
+
+def _defining_class(cls, name):
+    """
+    Returns the class of the MRO of 'cls' that defines the attribute 'name'.
+    """
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            return base
+
+def _batch_conversion(converter):
+    """
+    Returns the function that converts many values at once for the given
+    converter, and the types of the values that it returns unchanged.  These
+    are only used if they are defined along with the converter's to_python(),
+    e.g. not for a subclass that only overrides to_python(), for which all the
+    values are converted with it.
+    """
+    cls = type(converter)
+    owner = _defining_class(cls, 'to_python')
+
+    batchconv = converter.to_python_batch
+    if not issubclass(_defining_class(cls, 'to_python_batch'), owner):
+        batchconv = lambda values: MormConv.to_python_batch(converter, values)
+
+    idtypes = converter.identity_types
+    if ('identity_types' not in getattr(converter, '__dict__', ()) and
+        not issubclass(_defining_class(cls, 'identity_types'), owner)):
+        idtypes = ()
+    return batchconv, frozenset(idtypes)
+
 
 
 # Encoding from the DBAPI-2.0 client interface.
@@ -411,10 +890,26 @@ class MormConvUnicode(MormConv):
             vuni = vuni.decode()
         return vuni # Keep as unicode, DBAPI takes care of encoding properly.
 
+    # The DBAPI may already return unicode, e.g. psycopg2 with its UNICODE
+    # extension.
+    identity_types = (unicode, type(None))
+
     def to_python(self, vstr):
         if vstr is not None:
+            if isinstance(vstr, unicode):
+                return vstr
             return vstr.decode(dbapi_encoding)
 
+    def to_python_batch(self, vstrs):
+        # Subclasses that override to_python() convert with it.
+        if _defining_class(type(self), 'to_python') is not MormConvUnicode:
+            return MormConv.to_python_batch(self, vstrs)
+        encoding = dbapi_encoding
+        return [(vstr.decode(encoding)
+                 if vstr is not None and not isinstance(vstr, unicode)
+                 else vstr)
+                for vstr in vstrs]
+
 class MormConvString(MormConv):
     """
     Conversion between database-encoded string to unicode type.
@@ -427,6 +922,10 @@ class MormConvString(MormConv):
         if encoding:
             self.encoding = encoding
         self.sameenc = (encoding == dbapi_encoding)
+        # Subclasses that override to_python() are always called.
+        self.is_identity = (self.sameenc and
+                            _defining_class(type(self), 'to_python')
+                            is MormConvString)
 
     def from_python(self, vuni):
         if isinstance(vuni, str):
@@ -444,6 +943,154 @@ class MormConvString(MormConv):
 
 
 
+# Builders for the SQL statements, cached because the same statements tend to
+# get generated over and over again by an application.
+
+@lru_cache(maxsize=1024)
+def _select_sql(tables, colnames, cond, distinct):
+    return "SELECT %s %s FROM %s %s" % (distinct and 'DISTINCT' or '',
+                                        ', '.join(colnames),
+                                        ','.join(x.tname() for x in tables),
+                                        cond)
+
+@lru_cache(maxsize=1024)
+def _cols_sql(colnames):
+    return ', '.join(colnames)
+
+@lru_cache(maxsize=256)
+def _plhold_sql(nbcols):
+    return ', '.join(['%s'] * nbcols)
+
+@lru_cache(maxsize=1024)
+def _set_sql(colnames):
+    return ', '.join(('%s = %%s' % x) for x in colnames)
+
+@lru_cache(maxsize=1024)
+def _insert_sql(tablename, colnames, cond):
+    return "INSERT INTO %s (%s) VALUES (%s) %s" % (
+        tablename, _cols_sql(colnames), _plhold_sql(len(colnames)), cond)
+
+@lru_cache(maxsize=1024)
+def _where_sql(colnames):
+    return 'WHERE ' + ' AND '.join(['%s = %%s' % x for x in colnames])
+
+@lru_cache(maxsize=1024)
+def _update_sql(tablename, colnames, cond):
+    return "UPDATE %s SET %s %s" % (tablename, _set_sql(colnames), cond)
+
+
+_prepared = weakref.WeakKeyDictionary()
+"""Statements prepared on each connection, a pair of an ordered dict of SQL
+string to the name of the prepared statement and the statement that executes
+it, least recently used first, and of the lock that serializes the
+preparations, for connections shared between threads."""
+
+_prepared_max = 64
+"""Maximum number of statements kept prepared on each connection.  The least
+recently used ones are deallocated (simply the oldest ones in Python 2, whose
+OrderedDict cannot reorder entries cheaply), for applications that build
+their conditions dynamically."""
+
+_prepared_lock = threading.Lock()
+"""Lock for adding connections to _prepared."""
+
+_prepared_ids = itercount(1)
+
+_re_plhold = re.compile('%(%|s)')
+
+def _prepare(cursor, sql, args):
+    """
+    Prepare the given statement, with positional placeholders, on the
+    connection of the cursor if this has not been done already.  Returns the
+    statement to execute instead of the original, which takes the same
+    arguments.  If the connection cannot be determined, or if some of the
+    arguments are lists or tuples, which the DBAPI expands into the statement
+    (e.g. for 'IN %s'), the original statement is returned.
+
+    The preparation is run in a savepoint, so that a statement that the server
+    cannot prepare (e.g. 'WHERE %s IS NULL', whose parameter has no type) does
+    not abort the transaction; the original statement is used for it instead.
+    """
+    for x in args:
+        if isinstance(x, (list, tuple)):
+            return sql
+
+    conn = getattr(cursor, 'connection', None)
+    try:
+        statements, lock = _prepared[conn]
+    except KeyError:
+        _prepared_lock.acquire()
+        try:
+            statements, lock = _prepared.setdefault(conn, (OrderedDict(),
+                                                           threading.Lock()))
+        finally:
+            _prepared_lock.release()
+    except TypeError:
+        return sql
+    try:
+        stmt = statements[sql][1]
+    except KeyError:
+        pass
+    else:
+        touch = getattr(statements, 'move_to_end', None)
+        if touch is not None:
+            try:
+                touch(sql)
+            except KeyError:
+                pass # Evicted by another thread.
+        return stmt
+
+    nbparams = [0]
+    def replace(mo):
+        if mo.group(1) == '%':
+            return '%'
+        nbparams[0] += 1
+        return '$%d' % nbparams[0]
+
+    lock.acquire()
+    try:
+        # Another thread may have prepared it in the meantime.
+        try:
+            return statements[sql][1]
+        except KeyError:
+            pass
+
+        while len(statements) >= _prepared_max:
+            oldname = statements.popitem(last=False)[1][0]
+            if oldname is not None:
+                cursor.execute('DEALLOCATE %s' % oldname)
+
+        name = 'antiorm_%d' % next(_prepared_ids)
+        prepare = 'PREPARE %s AS %s' % (name, _re_plhold.sub(replace, sql))
+        if getattr(conn, 'autocommit', False):
+            # Without a transaction, a failure does not affect anything else.
+            savepoint = None
+        else:
+            savepoint = 'antiorm_prepare'
+            cursor.execute('SAVEPOINT %s' % savepoint)
+        try:
+            cursor.execute(prepare)
+        except getattr(conn, 'Error', Exception):
+            if savepoint is not None:
+                cursor.execute('ROLLBACK TO SAVEPOINT %s' % savepoint)
+                cursor.execute('RELEASE SAVEPOINT %s' % savepoint)
+            # Remember to use the original statement.
+            statements[sql] = (None, sql)
+            return sql
+        if savepoint is not None:
+            cursor.execute('RELEASE SAVEPOINT %s' % savepoint)
+
+        if nbparams[0]:
+            stmt = 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * nbparams[0]))
+        else:
+            stmt = 'EXECUTE %s' % name
+        statements[sql] = (name, stmt)
+        return stmt
+    finally:
+        lock.release()
+
+
+
 class MormEndecBase(object):
     """
     Base class for classes that accept list of tables.
@@ -462,6 +1109,22 @@ class MormEndecBase(object):
         can also pass in a single table class, or a sequence of table"""
         assert self.tables
 
+    def _converters(self):
+        """
+        Returns a dict of the converters to use for each column name, the
+        first table that declares a converter for a column having precedence.
+        This is computed only once for each list of tables, so the converters
+        of a table should not be modified after it has been used.
+        """
+        try:
+            return _merged_converters[self.tables]
+        except KeyError:
+            merged = {}
+            for cls in reversed(self.tables):
+                merged.update(cls.converters)
+            _merged_converters[self.tables] = merged
+            return merged
+
     def table(self):
         return self.tables[0].tname()
 
@@ -470,6 +1133,48 @@ class MormEndecBase(object):
 
 
 
+_merged_converters = {}
+"""Cache of the merged converters for each tuple of tables."""
+
+
+def _intern(name):
+    # Python 2 cannot intern unicode strings.
+    if type(name) is str:
+        return intern(name)
+    return name
+
+@lru_cache(maxsize=1024)
+def _intern_colnames(colnames):
+    """
+    Returns a tuple of the given column names, interned.  The tuple is shared
+    between the decoders for the same columns, and the attributes of the decoded
+    objects share the same name strings.
+    """
+    return tuple(_intern(x) for x in colnames)
+
+
+@lru_cache(maxsize=1024)
+def _gen_convert(converters):
+    """
+    Generate a function that converts the values of a row, given the list of
+    conversion functions for its columns (None for no conversion), and returns
+    them as a tuple.  The loop over the columns is unrolled in the generated
+    code.
+    """
+    env, exprs = {}, []
+    for i, conv in enumerate(converters):
+        if conv is None:
+            exprs.append('row[%d]' % i)
+        else:
+            env['conv%d' % i] = conv
+            exprs.append('conv%d(row[%d])' % (i, i))
+
+    code = 'def convert(row):\n    return (%s,)\n' % ', '.join(exprs)
+    exec(code, env)
+    return env['convert']
+
+
+
 class MormDecoder(MormEndecBase):
     """
     Decoder class that takes care of creating instances with appropriate
@@ -479,10 +1184,10 @@ class MormDecoder(MormEndecBase):
         MormEndecBase.__init__(self, tables)
 
         if isinstance(desc, (tuple, list)):
-            colnames = desc
+            colnames = _intern_colnames(tuple(desc))
         else:
             assert desc is not None
-            colnames = [x[0] for x in desc.description]
+            colnames = _intern_colnames(tuple(x[0] for x in desc.description))
 
         assert colnames
         self.colnames = colnames
@@ -492,9 +1197,54 @@ class MormDecoder(MormEndecBase):
         #
         # if colnames is not None: # Remove dotted notation if present.
         #     self.colnames = [c.split('.')[-1] for c in colnames]
-        self.attrnames = dict((c, c.split('.')[-1]) for c in colnames)
+        self._resolve_converters()
         assert len(self.attrnames) == len(self.colnames)
 
+    def _resolve_converters(self):
+        """
+        Compute the list of attribute names for the decoder's columns and a
+        function that converts all the values of a row at once, so that
+        decoding a row does not have to look for converters.
+        """
+        self.attrnames = dict((c, c.split('.')[-1]) for c in self.colnames)
+
+        # Map of table names to tables, the first table of a name having
+        # precedence.
+        tables = dict((cls.tname(), cls) for cls in reversed(self.tables))
+
+        names, convs, batchconvs, idtypes = [], [], [], []
+        for cname in self.colnames:
+            converter = None
+            attrname = self.attrnames[cname]
+            if attrname != cname:
+                # Get the table with the matching name and use the converter on
+                # this table if there is one.
+                cls = tables.get(cname.split('.')[0], None)
+                if cls is not None:
+                    converter = cls.converters.get(attrname, None)
+                cname = attrname
+            else:
+                # Use the first appropriate found converter in the table list.
+                converter = self._converters().get(cname, None)
+
+            names.append(_intern(cname))
+            if converter is not None and not converter.is_identity:
+                convs.append(converter.to_python)
+                batchconv, types = _batch_conversion(converter)
+                batchconvs.append(batchconv)
+                idtypes.append(types)
+            else:
+                convs.append(None)
+                batchconvs.append(None)
+                idtypes.append(None)
+
+        self._names = names
+        self._rowcls = None
+        self._convert = _gen_convert(tuple(convs))
+        self._batchconvs = batchconvs
+        self._idtypes = idtypes
+        self._convcolnames = self.colnames
+
     def cols(self):
         """
         Return a list of field names, suitable for insertion in a query.
@@ -508,106 +1258,169 @@ class MormDecoder(MormEndecBase):
         if len(self.colnames) != len(row):
             raise MormError("Row has incorrect length for decoder.")
 
+        # Recompute the converters if the columns have been changed.
+        if self._convcolnames is not self.colnames:
+            self._resolve_converters()
+
         # Convert all the values right away.  We assume that the query is
         # minimal and that we're going to need to access all the values.
         if obj is None:
-            if objcls is not None:
-                # Use the given class if present.
-                obj = objcls()
-            else:
-                # Otherwise look in the list of tables, one-by-one until we find
-                # an object class to use.
-                for table in self.tables:
-                    if table.objcls is not None:
-                        obj = table.objcls()
-                        break
-                else:
-                    # Otherwise just use the default
-                    obj = MormObject()
-
-        for cname, cvalue in zip(self.colnames, row):
-            if '.' in cname:
-                # Get the table with the matching name and use the converter on
-                # this table if there is one.
-                comps = cname.split('.')
-                tablename, cname = comps[0], comps[-1]
-                for cls in self.tables:
-                    if cls.tname() == tablename:
-                        converter = cls.converters.get(cname, None)
-                        if converter is not None:
-                            cvalue = converter.to_python(cvalue)
-                        break
-            else:
-                # Look in the table list for the first appropriate found
-                # converter.
-                for cls in self.tables:
-                    converter = cls.converters.get(cname, None)
-                    if converter is not None:
-                        cvalue = converter.to_python(cvalue)
-                        break
-
-            ## setattr(obj, self.attrnames[cname], cvalue)
-            setattr(obj, cname, cvalue)
+            obj = self._objcls(objcls)()
+
+        attrs = zip(self._names, self._convert(row))
+        if type(obj) is MormObject:
+            # Plain containers have no descriptors, set all the attributes at
+            # once.
+            obj.__dict__.update(attrs)
+        else:
+            for cname, cvalue in attrs:
+                setattr(obj, cname, cvalue)
         return obj
 
-    def iter(self, cursor, objcls=None):
+    def decode_all(self, rows, objcls=None):
+        """
+        Decode a list of rows, converting the values one column at a time.
+        Returns a list of new objects.
+        """
+        if not rows:
+            return []
+
+        # Recompute the converters if the columns have been changed.
+        if self._convcolnames is not self.colnames:
+            self._resolve_converters()
+
+        columns = list(zip(*rows))
+        if len(columns) != len(self.colnames):
+            raise MormError("Row has incorrect length for decoder.")
+        # Leave the columns whose values would all be returned unchanged.
+        columns = [(values
+                    if conv is None or (types and types.issuperset(
+                        map(type, values)))
+                    else conv(values))
+                   for conv, types, values in zip(self._batchconvs,
+                                                  self._idtypes, columns)]
+
+        objcls = self._objcls(objcls)
+        names = self._names
+        objects = []
+        for values in zip(*columns):
+            obj = objcls()
+            if type(obj) is MormObject:
+                obj.__dict__.update(zip(names, values))
+            else:
+                for cname, cvalue in zip(names, values):
+                    setattr(obj, cname, cvalue)
+            objects.append(obj)
+        return objects
+
+    def _objcls(self, objcls=None):
+        """
+        Returns the class of the objects to create, the given one if present.
+        """
+        if objcls is None:
+            # Otherwise look in the list of tables, one-by-one until we find
+            # an object class to use, or just use the default.
+            objcls = MormObject
+            for table in self.tables:
+                if table.objcls is not None:
+                    objcls = table.objcls
+                    break
+
+        # Use a class with slots for the columns for MormRow, created once per
+        # decoder (the class cache is not available in Python 2).
+        if objcls is MormRow:
+            objcls = self._rowcls
+            if objcls is None:
+                objcls = self._rowcls = _row_class(tuple(self._names))
+        return objcls
+
+    def iter(self, cursor, objcls=None, prefetch=None):
         """
         Create an iterator on the given cursor.
         This also deals with the case where a cursor has no results.
+        'prefetch' is the number of rows to fetch from the cursor at once (see
+        MormDecoderIterator.batchsize).
         """
         if cursor is None:
             raise MormError("No cursor to iterate.")
-        return MormDecoderIterator(self, cursor, objcls)
+        return MormDecoderIterator(self, cursor, objcls, prefetch=prefetch)
 
 
     #---------------------------------------------------------------------------
 
     @staticmethod
     def do_select(conn, tables, colnames=None, cond=None, condargs=None,
-                  distinct=None):
+                  distinct=None, cursor_name=None, prepared=False):
         """
         Guts of the select methods.  You need to pass in a valid connection
-        'conn'.  This returns a new cursor from the given connection.
+        'conn'.  This returns a new cursor from the given connection, a named
+        (server-side) cursor if 'cursor_name' is given.  If 'prepared' is true,
+        the select is run through a server-side prepared statement, unless the
+        condition uses named arguments.
 
         Note that this method is limited to be able to select on a single table
         only.  If you want to select on multiple tables at once you will need to
         do the select yourself.
         """
-        tablenames = ','.join(x.tname() for x in tables)
-
         if colnames is None:
             colnames = ('*',)
 
         if cond is None:
             cond = ''
         if condargs is None:
-            condargs = []
+            condargs = ()
         else:
             assert isinstance(condargs, (tuple, list, dict))
 
         assert conn is not None
 
         # Run the query.
-        cursor = conn.cursor()
+        if cursor_name is not None:
+            cursor = conn.cursor(cursor_name)
+        else:
+            cursor = conn.cursor()
 
-        distinct = distinct and 'DISTINCT' or ''
-        sql = "SELECT %s %s FROM %s %s" % (distinct, ', '.join(colnames),
-                                           tablenames, cond)
+        sql = _select_sql(tuple(tables), tuple(colnames), cond, bool(distinct))
+        if prepared and not isinstance(condargs, dict):
+            sql = _prepare(cursor, sql, condargs)
         cursor.execute(sql, condargs)
 
         return cursor
 
 
+@lru_cache(maxsize=1024)
+def _shared_decoder(tables, colnames):
+    return MormDecoder(tables, colnames)
+
+
 
 class MormDecoderIterator(object):
     """
-    Iterator for a decoder.
+    Iterator for a decoder.  Rows are fetched from the cursor in batches, so
+    you should not fetch from the cursor yourself while iterating.
     """
-    def __init__(self, decoder, cursor, objcls=None):
+    batchsize = 1000
+    """Number of rows to fetch from the cursor at once."""
+
+    def __init__(self, decoder, cursor, objcls=None, rows=None, prefetch=None):
         self.decoder = decoder
         self.cursor = cursor
         self.objcls = objcls
 
+        # Override the number of rows to fetch at once, also on the cursor, for
+        # the fetches that would be done on it directly.
+        if prefetch is not None:
+            self.batchsize = cursor.arraysize = prefetch
+
+        # Rows fetched from the cursor but not decoded yet.
+        self._rows = deque()
+        if rows:
+            self._rows.extend(rows)
+
+        # Bind the methods used for every row.
+        self._fetchmany = cursor.fetchmany
+        self._decode = decoder.decode
+
     def __len__(self):
         return self.cursor.rowcount
 
@@ -615,17 +1428,18 @@ class MormDecoderIterator(object):
         return self
 
     def next(self, obj=None, objcls=None):
-        if self.cursor.rowcount == 0:
-            raise StopIteration
-
         if objcls is None:
             objcls = self.objcls
 
-        row = self.cursor.fetchone()
-        if row is None:
-            raise StopIteration
-        else:
-            return self.decoder.decode(row, obj, objcls)
+        rows = self._rows
+        if not rows:
+            rows.extend(self._fetchmany(self.batchsize))
+            if not rows:
+                raise StopIteration
+
+        return self._decode(rows.popleft(), obj, objcls)
+
+    __next__ = next
 
 
 
@@ -641,30 +1455,40 @@ class MormEncoder(MormEndecBase):
         self.colnames = []
         """Names of all the columns of the encoder."""
 
-        self.colvalues = []
+        self.colvalues = ()
         """Encoded values of all the fields of the encoder."""
 
         # Set column names and values, converting if necessary.
-        for cname, cvalue in list(fields.items()):
-            self.colnames.append(cname)
+        colnames, colvalues = self.colnames, []
+        getconv = self._converters().get
+        for cname, cvalue in fields.items():
+            colnames.append(cname)
 
             # Apply converter to value if necessary
-            for cls in self.tables:
-                converter = cls.converters.get(cname, None)
-                if converter is not None:
-                    cvalue = converter.from_python(cvalue)
-                    break
+            converter = getconv(cname)
+            if converter is not None:
+                cvalue = converter.from_python(cvalue)
 
-            self.colvalues.append(cvalue)
+            colvalues.append(cvalue)
+        self.colvalues = tuple(colvalues)
 
     def cols(self):
-        return ', '.join(self.colnames)
+        return _cols_sql(tuple(self.colnames))
 
     def values(self):
         """
         Returns the list of converted values.
         This is useful to let DBAPI do the automatic quoting.
         """
+        return list(self.colvalues)
+
+    def _params(self, args):
+        """
+        Returns the query arguments for the converted values followed by the
+        given condition arguments.
+        """
+        if args:
+            return self.colvalues + tuple(args)
         return self.colvalues
 
     def plhold(self):
@@ -672,14 +1496,14 @@ class MormEncoder(MormEndecBase):
         Returns a string for holding replacement values in the query string,
         e.g.: %s, %s, %s
         """
-        return ', '.join(['%s'] * len(self.colvalues))
+        return _plhold_sql(len(self.colvalues))
 
     def set(self):
         """
         Returns a string for holding 'set values' syntax in the query string,
         e.g.: col1 = %s, col2 = %s, col3 = %s
         """
-        return ', '.join(('%s = %%s' % x) for x in self.colnames)
+        return _set_sql(tuple(self.colnames))
 
     def insert(self, conn, cond=None, args=None):
         """
@@ -699,12 +1523,29 @@ class MormEncoder(MormEndecBase):
         # Run the query.
         cursor = conn.cursor()
 
-        sql = ("INSERT INTO %s (%s) VALUES (%s) %s" %
-               (self.table(), self.cols(), self.plhold(), cond))
-        cursor.execute(sql, list(self.values()) + list(args))
+        sql = _insert_sql(self.table(), tuple(self.colnames), cond)
+        params = self._params(args)
+        if self.tables[0].use_prepared:
+            sql = _prepare(cursor, sql, params)
+        cursor.execute(sql, params)
 
         return cursor
 
+    def insert_returning(self, conn, cond=None, args=None, cols=None):
+        """
+        Execute a simple insert statement like insert(), that also returns the
+        given columns of the new row (all of them by default).  Returns the
+        cursor, from which the new row can be fetched.  This requires a database
+        that supports INSERT ... RETURNING, such as PostgreSQL.  Note: this does
+        not commit the connection.
+        """
+        if cond is None:
+            cond = ''
+        if cols is None:
+            cols = ('*',)
+        cond = '%s RETURNING %s' % (cond, ', '.join(cols))
+        return self.insert(conn, cond, args)
+
     def update(self, conn, cond=None, args=None):
         """
         Execute a simple update statement with the contained values.  You can
@@ -724,8 +1565,72 @@ class MormEncoder(MormEndecBase):
         # Run the query.
         cursor = conn.cursor()
 
-        sql = "UPDATE %s SET %s %s" % (self.table(), self.set(), cond)
-        cursor.execute(sql, list(self.values()) + list(args))
+        sql = _update_sql(self.table(), tuple(self.colnames), cond)
+        cursor.execute(sql, self._params(args))
 
         return cursor
 
+
+
+
+class MormInsertBuffer(object):
+    """
+    Buffer for single-row inserts, which sends them to the database in batches
+    using MormTable.insert_many().  Consecutive inserts in the same table and
+    with the same columns are batched together; inserting in another table or
+    with other columns flushes the pending rows first, so that the rows are
+    always inserted in order.
+
+    You must call flush() or commit() when you are done inserting, or use the
+    buffer in a 'with' statement, which flushes the pending rows if no
+    exception occurred.  Note that rows only reach the database when flushed,
+    so any error from them is raised at that time.
+    """
+    def __init__(self, conn, maxrows=1000):
+        assert conn is not None
+        self.conn = conn
+        self.maxrows = maxrows
+        """Maximum number of rows to buffer before flushing them."""
+
+        self._key = None
+        self._rows = []
+
+    def insert(self, table, **fields):
+        """
+        Buffer a row to be inserted in the given table, like MormTable.insert().
+        """
+        key = (table, tuple(sorted(fields)))
+        if key != self._key:
+            self.flush()
+            self._key = key
+
+        self._rows.append(fields)
+        if len(self._rows) >= self.maxrows:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert all the pending rows.  Note: this does not commit the
+        connection.
+        """
+        if self._rows:
+            table = self._key[0]
+            rows, self._rows = self._rows, []
+            table.insert_many(self.conn, rows)
+
+    def commit(self):
+        """
+        Insert all the pending rows and commit the connection.
+        """
+        self.flush()
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            # Do not send the pending rows, the transaction is going to fail.
+            self._rows = []
@@ -86,7 +86,8 @@ them::
     ...
     conn.release()
 
-We recommend using a try-finally form to make it exception-safe::
+We recommend using the 'with' statement (see below), or otherwise a try-finally
+form, to make it exception-safe::
 
     conn = dbpool().connection()
     try:
@@ -101,9 +102,21 @@ deal.
 
 Using the 'with' statement
 --------------------------
-::
+The connection objects are context managers, which release the connection at
+the end of the block::
 
-    with conn, cursor = dbpool().connection(1):
+    with dbpool().connection() as conn:
+        cursor = conn.cursor()
+        ...
+
+On exiting the block, a read-and-write connection is also committed, or rolled
+back if an exception was raised.
+
+For tight loops, the raw_connection() and raw_connection_ro() context managers
+provide the underlying DBAPI connection itself, without a wrapper object::
+
+    with dbpool().raw_connection_ro() as conn:
+        cursor = conn.cursor()
         ...
 
 
@@ -163,8 +176,14 @@ __copyright__ = 'Copyright (C) 2006 Martin Blais. All Rights Reserved.'
 
 
 # stdlib imports
-import os, types, threading, gc, warnings
-from datetime import datetime, timedelta
+import os, types, threading, warnings, weakref
+from collections import deque
+from contextlib import contextmanager
+from time import sleep
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic # Python 2
 
 
 __all__ = ('ConnectionPool', 'Error', 'dbpool', 'ConnOp')
@@ -406,6 +425,25 @@ class ConnectionPoolInterface(object):
         See connection() for details.
         """
 
+    def raw_connection(self):
+        """
+        Context manager that acquires a connection for read and write
+        operations, without wrapping it, for the duration of a 'with' block::
+
+           with dbpool.raw_connection() as conn:
+               ...
+
+        The connection is committed at the end of the block, or rolled back if
+        an exception is raised, and released.  You must not close it nor use it
+        after the block.
+        """
+
+    def raw_connection_ro(self):
+        """
+        Like raw_connection(), for read-only operations.  You must not commit
+        the connection.
+        """
+
     def finalize(self):
         """
         Finalize the pool, which closes remaining open connections.
@@ -430,6 +468,11 @@ class ConnectionPool(ConnectionPoolInterface):
     """The minimum amount of seconds that we should keep connections around
     for."""
 
+    _def_maxidle = None # seconds
+    """If set, the pool keeps any connection that has been idle for less than
+    this amount of seconds, and closes the older ones regardless of 'minconn'
+    (None means that the 'minconn' / 'minkeepsecs' heuristic is used)."""
+
     _def_disable_rollback = False
     """Should we disable the rollback on released connections?"""
 
@@ -438,6 +481,17 @@ class ConnectionPool(ConnectionPoolInterface):
         'dbapi': the DBAPI-2.0 module interface for creating connections.
         'minconn': the minimum number of connections to keep around.
         'maxconn': the maximum allowed number of connections to the DB.
+        'minkeepsecs': how long to keep the connections above 'minconn'.
+        'maxidle': how long to keep idle connections, instead of 'minconn' and
+                   'minkeepsecs' (see _def_maxidle).
+        'prewarm': flag to open 'minconn' connections right away.
+        'pruner': flag to scale down the pool from a background thread, every
+                  'maxidle' or 'minkeepsecs' seconds, instead of on release.
+        'thread_cache': flag to keep the last connection released by each
+                        thread for that thread's next acquire (see
+                        _release()); this cannot be used with 'maxconn'.
+                        The connections kept by threads that have exited
+                        go back to the pool when a new thread acquires.
         'debug': flag to enable printing debugging output.
         '**params': connection parameters for creating a new connection.
         """
@@ -450,20 +504,37 @@ class ConnectionPool(ConnectionPoolInterface):
                         "order to creat4e a connection pool.")
         """The parameters for creating a connection."""
 
-        self._pool = []
-        self._pool_lock = threading.Condition(threading.RLock())
-        """A pool of database connections and an associated lock for access."""
+        self._pool = deque()
+        self._pool_times = deque()
+        self._pool_lock = threading.Lock()
+        """A pool of database connections and an associated lock for access.
+        The pool holds the connections, the most recently released connection
+        last, and the release times of the connections are held in parallel,
+        in a separate deque."""
 
         self._nbconn = 0
         """The total number read-write database connections that were handed
         out.  This does not include the RO connection, if it is created."""
 
-        self._roconn = None
+        self._nbcreated = 0
+        """The total number of read-write connections created so far (protected
+        by the pool lock)."""
+
+        self._waiters = deque()
+        """The threads waiting for a connection to be released, in order
+        (protected by the pool lock).  Each waiter is an [event, connection]
+        list; the releasing thread sets the connection, or None to let the
+        waiter create a new one, then sets the event."""
+
         self._roconn_lock = threading.Lock()
-        self._roconn_refs = 0
+        self._set_roconn(None)
         """A connection for read-only access and an associated lock for
-        creation.  We also store the number of references to it that were
-        handled to clients."""
+        creation.  We also store the references to it that were handled to
+        clients, one item per reference (see _set_roconn())."""
+
+        self._wrappers = weakref.WeakSet()
+        """The connection wrappers handed out, so that the ones that have not
+        been released can be found on finalization."""
 
         if options is None:
             options = {}
@@ -473,6 +544,11 @@ class ConnectionPool(ConnectionPoolInterface):
             assert hasattr(self._debug, 'write')
             self._log_lock = threading.Lock()
             """Lock used to serialize debug output between threads."""
+            self._log_records = deque()
+            """Debugging records waiting to be written.  Deque appends are
+            atomic, so that logging does not take the lock; the records are
+            written by a background thread (and on finalization)."""
+            self._start_log_writer()
 
         disable_ro = options.pop('disable_ro', False)
         if not disable_ro and dbapi.threadsafety < 2:
@@ -499,7 +575,12 @@ class ConnectionPool(ConnectionPoolInterface):
                 self._maxconn -= 1
             assert self._maxconn > 0
 
-        self._minkeepsecs = options.pop('minkeepsecs', self._def_minkeepsecs)
+        self._minkeepsecs = float(options.pop('minkeepsecs',
+                                              self._def_minkeepsecs))
+
+        self._maxidle = options.pop('maxidle', self._def_maxidle)
+        if self._maxidle is not None:
+            self._maxidle = float(self._maxidle)
 
         self._disable_rollback = options.pop('disable_rollback',
                                              self._def_disable_rollback)
@@ -518,6 +599,31 @@ class ConnectionPool(ConnectionPoolInterface):
 
         self._isolation_level = options.pop('isolation_level', None)
 
+        self._tls = None
+        self._parked = []
+        """Per-thread storage for the connections kept by each thread, if
+        enabled, and the list of all the (thread, slot) pairs, a slot being a
+        deque holding at most one (connection, release time) pair.  The
+        connections in the slots are counted as handed out."""
+        if options.pop('thread_cache', False):
+            if self._maxconn is not None:
+                raise Error("The 'thread_cache' option cannot be used with "
+                            "'maxconn'.")
+            self._tls = threading.local()
+
+            # Look for the thread's connection before going to the pool.
+            self._acquire_pool = self._acquire
+            self._acquire = self._acquire_kept
+
+        self._pruner = None
+        """The thread that scales down the pool periodically, if enabled, and
+        the event that stops it."""
+        if options.pop('pruner', False):
+            self._start_pruner()
+
+        if options.pop('prewarm', False):
+            self._prewarm()
+
     def ro_shared(self):
         """
         Returns true if the read-only connections are shared between the
@@ -536,126 +642,366 @@ class ConnectionPool(ConnectionPoolInterface):
         Debugging information logging.
         """
         if self._debug:
-            self._log_lock.acquire()
-            curthread = threading.currentThread()
-            self._debug.write('   [%s %s] %s\n' %
-                              (curthread.getName(), os.getpid(), msg))
+            self._log_records.append(
+                (threading.currentThread().getName(), os.getpid(), msg))
+
+    def _start_log_writer(self):
+        """
+        Start the thread that writes the debugging records.  Like the pruner,
+        it only holds a weak reference to the pool.
+        """
+        writer = threading.Thread(target=_log_loop,
+                                  args=(weakref.ref(self), 0.1))
+        writer.daemon = True
+        writer.start()
+
+    def _flush_log(self):
+        """
+        Write out the pending debugging records.
+        """
+        records, write = self._log_records, self._debug.write
+        self._log_lock.acquire()
+        try:
+            while records:
+                write('   [%s %s] %s\n' % records.popleft())
+        finally:
             self._log_lock.release()
 
     def _create_connection(self, read_only):
         """
         Create a new connection to the database.
         """
-        self._log('Connection Create%s' % (read_only and ' (READ ONLY)' or ''))
+        if self._debug:
+            self._log('Connection Create%s' %
+                      (read_only and ' (READ ONLY)' or ''))
         params = self._params
         if read_only and self._user_ro:
             params = params.copy()
             params['user'] = self._user_ro
 
-        newconn = self.dbapi.connect(*(), **params)
+        newconn = self.dbapi.connect(**params)
 
         # Set the isolation level if specified in the options.
         if self._isolation_level is not None:
             newconn.set_isolation_level(self._isolation_level)
         return newconn
 
+    def _start_pruner(self):
+        """
+        Start the pruner thread.  It only holds a weak reference to the pool, so
+        that the pool can still be collected (and finalized).
+        """
+        interval = self._maxidle
+        if interval is None:
+            interval = self._minkeepsecs
+        self._stopping = threading.Event()
+        self._pruner = threading.Thread(target=_prune_loop,
+                                        args=(weakref.ref(self),
+                                              self._stopping, interval))
+        self._pruner.daemon = True
+        self._pruner.start()
+
+    def _stop_pruner(self):
+        """
+        Stop the pruner thread, if it is running.  Afterwards, the pool scales
+        down on release again.
+        """
+        pruner = self._pruner
+        if pruner is None:
+            return
+        self._pruner = None
+        self._stopping.set()
+        if pruner is not threading.currentThread():
+            pruner.join()
+
+    def _prune(self):
+        """
+        Scale down the pool.  This is run periodically by the pruner thread.
+        """
+        lock = self._pool_lock
+        lock.acquire()
+        try:
+            closed = list(self._scaledown())
+            closed.extend(self._reclaim_parked())
+        finally:
+            lock.release()
+
+        for conn in closed:
+            self._close(conn)
+
+    def _prewarm(self):
+        """
+        Open the minimum number of connections and put them in the pool, so
+        that the first clients do not have to pay for connecting.  The
+        connections are created concurrently, by a few threads.
+        """
+        n = self._minconn
+        if self._maxconn is not None:
+            n = min(n, self._maxconn)
+        if n <= 0:
+            return
+
+        slots = list(xrange(n))
+        conns = []
+        def connect():
+            while True:
+                try:
+                    slots.pop()
+                except IndexError:
+                    return
+                try:
+                    conns.append(self._create_connection(False))
+                except self.dbapi.Error as e:
+                    # Leave it to the clients to create it later on.
+                    self._log('Prewarm failed: %s' % e)
+
+        threads = [threading.Thread(target=connect)
+                   for i in xrange(min(n, 8))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        lock = self._pool_lock
+        lock.acquire()
+        try:
+            self._pool.extend(conns)
+            self._pool_times.extend([monotonic()] * len(conns))
+            self._nbconn += len(conns)
+            self._nbcreated += len(conns)
+        finally:
+            lock.release()
+
     def _close(self, conn):
         """
         Close the given connection for the database.
         """
-        self._log('Connection Close')
+        if self._debug:
+            self._log('Connection Close')
         return conn.close()
 
     @staticmethod
     def _add_cursors(conn_wrapper, nbcursors):
         """
-        Return an appropriate value depending on the number of cursors requested
-        for a connection wrapper.
+        Return a list of the connection wrapper followed by the requested number
+        of cursors on it.  The callers return the wrapper alone themselves when
+        no cursors are requested, which is the common case.
         """
-        if nbcursors == 0:
-            return conn_wrapper
-        else:
-            r = [conn_wrapper]
-            for i in xrange(nbcursors):
-                r.append(conn_wrapper.cursor())
-            return r
+        return [conn_wrapper] + [conn_wrapper.cursor()
+                                 for i in xrange(nbcursors)]
+
+    def _set_roconn(self, conn):
+        """
+        Set the read-only connection, with a new container for its references.
+        The references are kept in a deque, whose appends and pops are atomic,
+        and the connection and its references are also published together as a
+        single pair, so that they can be acquired without taking the lock.
+        This must be called with the RO lock held (or during initialization).
+        """
+        self._roconn = conn
+        self._roconn_refs = deque()
+        self._roconn_shared = (conn, self._roconn_refs)
 
     def _get_connection_ro(self):
         """
         Acquire a read-only connection.
         """
-        self._roconn_lock.acquire()
-        self._log('Acquire RO')
-        try:
-            if not self._roconn:
-                self._roconn = self._create_connection(True)
-            self._roconn_refs += 1
-        finally:
-            self._roconn_lock.release()
-        return self._roconn
+        # Only take the lock if the connection has to be created.
+        conn, refs = self._roconn_shared
+        if conn is None:
+            self._roconn_lock.acquire()
+            try:
+                if not self._roconn:
+                    self._set_roconn(self._create_connection(True))
+                conn, refs = self._roconn_shared
+            finally:
+                self._roconn_lock.release()
+        refs.append(None)
+        if self._debug:
+            self._log('Acquire RO')
+        return conn
 
     def connection_ro(self, nbcursors=0):
         """
         (See base class.)
         """
-        return self._add_cursors(
-            ConnectionWrapperRO(self._get_connection_ro(), self), nbcursors)
+        wrapper = ConnectionWrapperRO(self._get_connection_ro(), self)
+        self._wrappers.add(wrapper)
+        if nbcursors:
+            return self._add_cursors(wrapper, nbcursors)
+        return wrapper
 
     def _acquire(self):
         """
         Acquire a connection from the pool, for read an write operations.
 
         Note that if the maximum number of connections has been reached, this
-        becomes a blocking operation.
+        becomes a blocking operation.  The waiting threads are served in order,
+        each released connection being handed to the thread that has waited
+        the longest.
         """
-        self._pool_lock.acquire()
-        self._log('Acquire (begin)  Pool: %d  / Created: %s' %
-                  (len(self._pool), self._nbconn))
+        lock = self._pool_lock
+        lock.acquire()
         try:
-            # Apply maximum number of connections constraint.
-            if self._maxconn is not None:
-                # Sanity check.
-                assert self._nbconn <= self._maxconn
-
-                while not self._pool and self._nbconn == self._maxconn:
-                    # Block until a connection is released.
-                    self._log('Acquire (wait)  Pool: %d  / Created: %s' %
-                              (len(self._pool), self._nbconn))
-                    self._pool_lock.wait()
-                    self._log('Acquire (signaled)  Pool: %d  / Created: %s' %
-                              (len(self._pool), self._nbconn))
-
-                # Assert that we have a connection in the pool or that we can
-                # create a new one if needed, i.e. what we waited for just
-                # before.  (This is now a useless sanity check.)
-                assert self._pool or self._nbconn < self._maxconn
+            if self._debug:
+                self._log('Acquire (begin)  Pool: %d  / Created: %s' %
+                          (len(self._pool), self._nbconn))
 
+            waiter = None
             if self._pool:
-                conn, last_released = self._pool.pop()
+                conn = self._pool.pop()
+                self._pool_times.pop()
+            elif self._maxconn is None or self._nbconn < self._maxconn:
+                # Reserve a slot for a new connection, which we create below,
+                # without holding the lock.
+                conn = None
+                self._nbconn += 1
+                self._nbcreated += 1
             else:
-                # Make sure that we never create a new connection if we have
-                # reached the maximum.
-                if self._maxconn is not None:
-                    assert self._nbconn < self._maxconn
+                # Apply maximum number of connections constraint: wait in line
+                # for a connection (or a slot) to be handed to us.
+                conn = None
+                waiter = [threading.Event(), None]
+                self._waiters.append(waiter)
+            poolsize, nbconn = len(self._pool), self._nbconn
+        finally:
+            lock.release()
+
+        if waiter is not None:
+            if self._debug:
+                self._log('Acquire (wait)  Pool: %d  / Created: %s' %
+                          (poolsize, nbconn))
+            try:
+                waiter[0].wait()
+            except:
+                self._cancel_wait(waiter)
+                raise
+            conn = waiter[1]
+            if self._debug:
+                self._log('Acquire (signaled)')
 
+        if conn is None:
+            try:
                 conn = self._create_connection(False)
-                self._nbconn += 1
+            except:
+                # Give the reserved slot back.
+                lock.acquire()
+                try:
+                    self._nbcreated -= 1
+                    self._free_slot()
+                finally:
+                    lock.release()
+                raise
 
+        if self._debug:
             self._log('Acquire (end  )  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
-        finally:
-            self._pool_lock.release()
+                      (poolsize, nbconn))
         return conn
 
+    def _acquire_kept(self):
+        """
+        Replacement for _acquire() with the 'thread_cache' option, which reuses
+        the connection kept by this thread, without locking, if there is one.
+        """
+        slot = getattr(self._tls, 'slot', None)
+        if slot:
+            try:
+                return slot.pop()[0]
+            except IndexError:
+                pass # Reclaimed by the pool in the meantime.
+        elif slot is None:
+            self._new_slot()
+        return self._acquire_pool()
+
+    def _new_slot(self):
+        """
+        Create the slot of the current thread for the 'thread_cache' option.
+        This is also when the connections kept by the threads that are gone are
+        put back in the pool, so that short-lived threads do not leave them
+        behind, even without a pruner.
+        """
+        slot = self._tls.slot = deque()
+        lock = self._pool_lock
+        lock.acquire()
+        try:
+            parked = []
+            for threadref, oslot in self._parked:
+                thread = threadref()
+                if thread is not None and thread.is_alive():
+                    parked.append((threadref, oslot))
+                    continue
+                try:
+                    conn = oslot.pop()[0]
+                except IndexError:
+                    continue
+                # Note: put it back as if just released, to keep the pool
+                # sorted.
+                self._pool.append(conn)
+                self._pool_times.append(monotonic())
+            parked.append((weakref.ref(threading.currentThread()), slot))
+            self._parked = parked
+        finally:
+            lock.release()
+        return slot
+
+    def _free_slot(self):
+        """
+        Give up the slot of a connection that is gone, handing it to the first
+        waiting thread, if any, for it to create a new connection.  This must be
+        called with the pool lock held.
+        """
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter[1] = None
+            self._nbcreated += 1
+            waiter[0].set()
+        else:
+            self._nbconn -= 1
+
+    def _cancel_wait(self, waiter):
+        """
+        Stop waiting for a connection, e.g. on KeyboardInterrupt.  If a
+        connection or a slot has already been handed to the waiter, give it
+        back.
+        """
+        lock = self._pool_lock
+        lock.acquire()
+        try:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                conn = waiter[1]
+                if conn is None:
+                    self._nbcreated -= 1
+                    self._free_slot()
+                elif self._waiters:
+                    self._handoff(conn)
+                else:
+                    self._pool.append(conn)
+                    self._pool_times.append(monotonic())
+        finally:
+            lock.release()
+
+    def _handoff(self, conn):
+        """
+        Hand a connection to the first waiting thread.  This must be called with
+        the pool lock held, and only if there are waiting threads.
+        """
+        waiter = self._waiters.popleft()
+        waiter[1] = conn
+        waiter[0].set()
+
     def _connection_ro_crippled(self, nbcursors=0):
         """
         Replacement for connection_ro() that actually uses the pool to get its
         connections.  This is used when the dbapi does not allow threads to
         share a connection.
         """
-        conn = self._acquire()
-        return self._add_cursors(ConnectionWrapperCrippled(conn, self),
-                                 nbcursors)
+        wrapper = ConnectionWrapperCrippled(self._acquire(), self)
+        self._wrappers.add(wrapper)
+        if nbcursors:
+            return self._add_cursors(wrapper, nbcursors)
+        return wrapper
 
     def _get_connection(self):
         """
@@ -669,8 +1015,43 @@ class ConnectionPool(ConnectionPoolInterface):
         """
         if readonly:
             return self.connection_ro(nbcursors)
-        return self._add_cursors(
-            ConnectionWrapper(self._get_connection(), self), nbcursors)
+        wrapper = ConnectionWrapper(self._get_connection(), self)
+        self._wrappers.add(wrapper)
+        if nbcursors:
+            return self._add_cursors(wrapper, nbcursors)
+        return wrapper
+
+    @contextmanager
+    def raw_connection(self):
+        """
+        (See base class.)
+        """
+        conn = self._get_connection()
+        try:
+            yield conn
+            conn.commit()
+        except:
+            # Like the wrappers, even if the pool does not roll back on release.
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def raw_connection_ro(self):
+        """
+        (See base class.)
+        """
+        if self._ro_shared:
+            conn = self._get_connection_ro()
+            release = self._release_ro
+        else:
+            conn = self._acquire()
+            release = self._release
+        try:
+            yield conn
+        finally:
+            release(conn)
 
     def _release_ro(self, conn):
         """
@@ -678,113 +1059,187 @@ class ConnectionPool(ConnectionPoolInterface):
         this directly, you should instead call release() or close() on the
         connection object.
         """
-        self._roconn_lock.acquire()
-
-        try:
-            if conn is self._roconn:
-                assert self._roconn
+        # Like for acquiring, we only need to take the lock to change the
+        # connection.
+        roconn, refs = self._roconn_shared
+        if conn is not roconn:
+            # Ignored the release of other hosed connections.
+            self._log('Hosed connection %s released after ditched.' % conn)
+            return
 
-                self._roconn_refs -= 1
-                self._log('Release RO')
+        refs.pop()
+        if self._debug:
+            self._log('Release RO')
 
-                # Make sure a released connection is not blocking anything else, so
-                # rollback.  Technically this should not block anything, since the
-                # only operations that are carried out on this connection are RO,
-                # but we won't risk a deadlock because the user made a programming
-                # error.
-                try:
-                    if not self._disable_rollback:
-                        conn.rollback()
-                except self.dbapi.Error:
-                    # This connection is hosed somehow, we should ditch it.
+        # Make sure a released connection is not blocking anything else, so
+        # rollback.  Technically this should not block anything, since the
+        # only operations that are carried out on this connection are RO, but
+        # we won't risk a deadlock because the user made a programming error.
+        try:
+            if not self._disable_rollback:
+                conn.rollback()
+        except self.dbapi.Error:
+            # This connection is hosed somehow, we should ditch it (unless
+            # another thread has already done so).
+            self._roconn_lock.acquire()
+            try:
+                if conn is self._roconn:
                     self._log('Ditching hosed RO connection: %s' % conn)
-                    self._roconn = None
-                    self._roconn_refs = 0
-            else:
-                # Ignored the release of other hosed connections.
-                self._log('Hosed connection %s released after ditched.' % conn)
-        finally:
-            self._roconn_lock.release()
+                    self._set_roconn(None)
+            finally:
+                self._roconn_lock.release()
 
     def _release(self, conn):
         """
         Release a reference to a read-and-write connection.
         """
-        self._pool_lock.acquire()
-        try:
-            self._log('Release (begin)  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
+        if self._debug:
+            self._log('Release (begin)')
+        assert conn is not self._roconn # Sanity check.
 
-            # Make sure a released connection is not blocking anything else.
-            try:
-                if not self._disable_rollback:
-                    conn.rollback()
-            except self.dbapi.Error:
-                # Oopsy, this connection is hosed somehow.  We need to ditch it.
-                self._log('Ditching hosed connection: %s' % conn)
-                conn = None
-                self._nbconn -= 1
+        # Make sure a released connection is not blocking anything else.  Do
+        # this before taking the lock, it involves a round-trip to the server.
+        try:
+            if not self._disable_rollback:
+                conn.rollback()
+        except self.dbapi.Error:
+            # Oopsy, this connection is hosed somehow.  We need to ditch it.
+            self._log('Ditching hosed connection: %s' % conn)
+            conn = None
+
+        # Keep the connection for this thread if its slot is free.  Only the
+        # owner thread adds to its slot, and the deque operations are atomic.
+        if conn is not None and self._tls is not None:
+            slot = getattr(self._tls, 'slot', None)
+            if slot is None:
+                slot = self._new_slot()
+            if not slot:
+                slot.append( (conn, monotonic()) )
                 return
 
-            assert conn is not self._roconn # Sanity check.
+        lock = self._pool_lock
+        lock.acquire()
+        try:
+            closed = ()
+            if conn is None:
+                self._free_slot()
+            elif self._waiters:
+                # Hand the connection over to the thread that has waited the
+                # longest.
+                self._handoff(conn)
+            else:
+                # Note: take the time under the lock, to keep the pool sorted.
+                self._pool.append(conn)
+                self._pool_times.append(monotonic())
+                if self._pruner is None:
+                    closed = self._scaledown()
+            poolsize, nbconn = len(self._pool), self._nbconn
+        finally:
+            lock.release()
 
-            self._pool.append( (conn, datetime.now()) )
-            self._scaledown()
-            assert self._pool or self._nbconn < self._maxconn
-            self._log('Release (notify)  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
-            self._pool_lock.notify()
-            self._log('Release (notified)  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
+        # Close the extra connections outside of the lock.
+        for conn in closed:
+            self._close(conn)
 
+        if self._debug:
             self._log('Release (end  )  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
-        finally:
-            self._pool_lock.release()
+                      (poolsize, nbconn))
 
     def _scaledown(self):
         """
         Scale down the number of connection according to the following
         heuristic: we want keep a minimum number of extra connections in the
         pool ready for usage.  We delete all connections above that number if
-        they have last been used beyond a fixed timeout.
+        they have last been used beyond a fixed timeout.  If the 'maxidle'
+        option is set, we keep any connection that has been idle for less than
+        that instead and evict the others only by age.
+
+        This must be called with the pool lock held.  The connections removed
+        from the pool are returned, for the caller to close them after
+        releasing the lock.
         """
-        self._pool_lock.acquire()
-        try:
-            self._log('Scaledown')
-
-            # Calculate a recent time limit beyond which we always keep the
-            # connections.
-            minkeepsecs = datetime.now() - timedelta(seconds=self._minkeepsecs)
-
-            # Calculate the number of connections that we can get rid of.
-            n = len(self._pool) - self._minconn
-            if n > 0:
-                filtered_pool = []
-                for poolitem in self._pool:
-                    conn, last_released = poolitem
-                    if n > 0 and last_released < minkeepsecs:
-                        self._close(conn)
-                        self._nbconn -= 1
-                        n -= 1
-                    else:
-                        filtered_pool.append(poolitem)
-                self._pool = filtered_pool
-        finally:
-            self._pool_lock.release()
+        pool, times = self._pool, self._pool_times
+
+        # Calculate the number of connections that we can get rid of.
+        if self._maxidle is not None:
+            n = len(pool)
+            keepsecs = self._maxidle
+        else:
+            n = len(pool) - self._minconn
+            keepsecs = self._minkeepsecs
+        if n <= 0:
+            return ()
+
+        # Calculate a recent time limit beyond which we always keep the
+        # connections.  The pool is sorted by release time, so the oldest
+        # connections, the candidates for removal, are first; in the common
+        # case, there are none to remove.
+        minkeepsecs = monotonic() - keepsecs
+        if times[0] >= minkeepsecs:
+            return ()
+
+        closed = []
+        popconn, poptime = pool.popleft, times.popleft
+        while n > 0 and times[0] < minkeepsecs:
+            poptime()
+            closed.append(popconn())
+            n -= 1
+        self._nbconn -= len(closed)
+        return closed
+
+    def _reclaim_parked(self, everything=False):
+        """
+        Take back the connections kept by the threads that are gone, or that
+        have kept them for longer than we keep connections in the pool.  If
+        'everything' is true, all the kept connections are taken back, and put
+        back in the pool.  This must be called with the pool lock held.  The
+        connections to close are returned.
+        """
+        closed = []
+        if everything:
+            limit = None
+        else:
+            keepsecs = self._maxidle
+            if keepsecs is None:
+                keepsecs = self._minkeepsecs
+            limit = monotonic() - keepsecs
+
+        parked = []
+        for threadref, slot in self._parked:
+            thread = threadref()
+            alive = thread is not None and thread.is_alive()
+            if alive and not everything:
+                parked.append((threadref, slot))
+
+            # Note: the owner thread may take the connection at any time.
+            try:
+                if alive and limit is not None and slot[-1][1] >= limit:
+                    continue
+                item = slot.pop()
+            except IndexError:
+                continue
+
+            if everything:
+                self._pool.appendleft(item[0])
+                self._pool_times.appendleft(item[1])
+            else:
+                closed.append(item[0])
+                self._nbconn -= 1
 
-        # Note: we could keep the pool sorted by last_released to minimize the
-        # scaledown time, so that the first items in the pool are always the
-        # oldest, the most likely to be deletable.
+        self._parked = parked
+        return closed
 
     def finalize(self):
         """
         Close all the open connections and finalize (prepare for reuse).
         """
-        # Make sure that all connections lying about are collected before we go
-        # on.
+        # Release the connections of the wrappers that have not been released
+        # yet.
         try:
-            gc.collect()
+            self._stop_pruner()
+            for wrapper in list(self._wrappers):
+                if wrapper._conn is not None:
+                    wrapper.release()
         except (TypeError, AttributeError):
             # We've detected that we're being called in an incomplete
             # finalization state, we just bail out, leaving the connections
@@ -794,6 +1249,11 @@ class ConnectionPool(ConnectionPoolInterface):
         self._roconn_lock.acquire()
         self._pool_lock.acquire()
         try:
+            # Take back the connections kept by the threads.
+            if self._tls is not None:
+                self._reclaim_parked(True)
+                self._tls = threading.local()
+
             if not self._pool and not self._roconn:
                 assert self._nbconn == 0
                 return # Already finalized.
@@ -801,20 +1261,22 @@ class ConnectionPool(ConnectionPoolInterface):
             # Check that all the connections have been returned to us.
             assert len(self._pool) == self._nbconn
 
-            assert self._roconn_refs == 0
+            assert not self._roconn_refs
             if self._roconn is not None:
                 self._close(self._roconn)
-                self._roconn = None
+                self._set_roconn(None)
 
             # Release all the read-write pool's connections.
-            for conn, last_released in self._pool:
+            for conn in self._pool:
                 self._close(conn)
 
             poolsize = len(self._pool)
-            self._pool = []
+            self._pool = deque()
+            self._pool_times = deque()
 
-            self._log('Finalize  Pool: %d  / Created: %s' %
-                      (poolsize, self._nbconn))
+            if self._debug:
+                self._log('Finalize  Pool: %d  / Created: %s' %
+                          (poolsize, self._nbconn))
 
             # Reset statistics.
             self._nbconn = 0
@@ -822,6 +1284,9 @@ class ConnectionPool(ConnectionPoolInterface):
             self._roconn_lock.release()
             self._pool_lock.release()
 
+        if self._debug:
+            self._flush_log()
+
     def __del__(self):
         """
         Destructor.
@@ -852,17 +1317,47 @@ class ConnectionPool(ConnectionPoolInterface):
 
         return total_conn, pool_size
 
+    def getusage(self):
+        """
+        Return usage statistics for monitoring the read-write connections: the
+        total number of connections created so far, the current number of
+        connections held in the internal pool and the number of connections
+        currently handed out.
+        """
+        self._pool_lock.acquire()
+        try:
+            pool_size = len(self._pool)
+            return self._nbcreated, pool_size, self._nbconn - pool_size
+        finally:
+            self._pool_lock.release()
+
     def forget_connections(self):
         """
         Forget all the existing connections and close the sockets.  This MUST be
         called from a child process right after forking.
         """
         self._roconn_lock = threading.Lock()
-        self._pool_lock = threading.Condition(threading.RLock())
+        self._pool_lock = threading.Lock()
 
-        self._roconn = None
-        self._pool = []
+        self._set_roconn(None)
+        self._pool = deque()
+        self._pool_times = deque()
         self._nbconn = 0
+        self._nbcreated = 0
+        self._waiters = deque()
+        self._wrappers = weakref.WeakSet()
+
+        # The pruner and log writer threads do not survive the fork.
+        self._pruner = None
+        if self._debug:
+            # The parent writes its own pending records.
+            self._log_records = deque()
+            self._log_lock = threading.Lock()
+            self._start_log_writer()
+
+        if self._tls is not None:
+            self._tls = threading.local()
+            self._parked = []
 
 ## FIXME: todo, close the file descriptors (unix ::close()
 ## FIXME: continue this, you need to fix the test: test_fork.py
@@ -870,6 +1365,31 @@ class ConnectionPool(ConnectionPoolInterface):
 
 
 
+def _prune_loop(poolref, stopping, interval):
+    """
+    Body of the pruner thread of a connection pool.
+    """
+    while not stopping.wait(interval):
+        pool = poolref()
+        if pool is None:
+            return
+        pool._prune()
+        del pool
+
+
+def _log_loop(poolref, interval):
+    """
+    Body of the debugging log writer thread of a connection pool.
+    """
+    while True:
+        sleep(interval)
+        pool = poolref()
+        if pool is None:
+            return
+        pool._flush_log()
+        del pool
+
+
 class ConnectionWrapperRO(object):
     """
     A wrapper object that behaves like a database connection for read-only
@@ -880,16 +1400,26 @@ class ConnectionWrapperRO(object):
     release explicitly, the pool has to keep the connection open.  Here is the
     preferred way to do this:
 
+       with dbpool.connection() as connection:
+           # you code here
+
+    which is equivalent to:
+
        connection = dbpool.connection()
        try:
            # you code here
        finally:
            connection.release()
 
+    (except that for read-and-write connections, the 'with' statement also
+    commits or rolls back, see ConnectionWrapper).
+
     Note that this connection wrapper does not allow committing.  It is meant
     for read-only operations (i.e. SELECT). See class ConnectionWrapper for the
     commit method.
     """
+    __slots__ = ('_conn', '_connpool', '__weakref__')
+
     def __init__(self, conn, pool):
         assert conn
         self._conn = conn
@@ -909,14 +1439,20 @@ class ConnectionWrapperRO(object):
             return self._conn
 
     def release(self):
-        self._release_impl(self._getconn())
+        conn = self._conn
+        if conn is None:
+            raise Error("Error: Connection already closed.")
+        self._release_impl(conn)
         self._connpool = self._conn = None
 
     def _release_impl(self, conn):
         self._connpool._release_ro(conn)
 
     def cursor(self, *args, **kw):
-        return self._getconn().cursor(*args, **kw)
+        conn = self._conn
+        if conn is None:
+            raise Error("Error: Connection already closed.")
+        return conn.cursor(*args, **kw)
 
     def commit(self):
         raise Error("Error: You cannot commit on a read-only connection.")
@@ -937,6 +1473,8 @@ class ConnectionWrapperCrippled(ConnectionWrapperRO):
     A wrapper object that releases to the pool.  It still does not provide a
     commit() method however.
     """
+    __slots__ = ()
+
     def _release_impl(self, conn):
         self._connpool._release(conn)
 
@@ -945,6 +1483,8 @@ class ConnectionWrapper(ConnectionWrapperCrippled):
     A wrapper object that allows write operations and provides a commit()
     method.  See ConnectionWrapperRO for more details.
     """
+    __slots__ = ()
+
     def commit(self):
         return self._getconn().commit()
 
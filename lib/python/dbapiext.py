@@ -45,6 +45,14 @@ http://furius.ca/pubcode/pub/conf/lib/python/dbapiext.html
     ...
     analq.execute(cursor, cols, id, t=table)
 
+  To run the same query for many rows of arguments, use executemany_f(),
+  which passes the rows on to the cursor's executemany() method::
+
+    executemany_f(cursor, ' INSERT INTO %(t)s VALUES (%S, %S) ', rows, t=table)
+
+  Long-running programs can also fill the cache ahead of time with warmup(),
+  e.g. in a parent process before forking worker processes.
+
 **Note to developers: this module contains tests, if you make any changes,
 please make sure to run and fix the tests.**
 
@@ -77,6 +85,7 @@ from datetime import date, datetime
 from itertools import starmap
 from itertools import count
 from pprint import pprint
+from collections import OrderedDict
 
 # These imports only work in Python 2.x, but the built-ins are fine in 3.x.
 try:
@@ -86,14 +95,9 @@ except ImportError:
     imap = map
     izip = zip
 
-# The first module is Python 2.x, the second is 3.x.
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
 
-
-__all__ = ('execute_f', 'qcompile', 'set_paramstyle', 'execute_obj')
+__all__ = ('execute_f', 'executemany_f', 'qcompile', 'set_paramstyle',
+           'execute_obj', 'warmup', 'set_cache_size')
 
 
 # Create aliases for Python 3.x compatibility
@@ -105,16 +109,13 @@ try:
     unicode
 except NameError:
     unicode = str
+try:
+    long
+except NameError:
+    long = int
 
 
-# Convenince function since Python 3.x has new syntax for next
-def _next(i):
-    try:
-        return i.next()
-    except AttributeError:
-        return next(i)
-
-# Ditto for dictionary iterators
+# Convenince functions since Python 3.x has no dictionary iterators
 def _iteritems(d):
     try:
         return d.iteritems()
@@ -139,9 +140,10 @@ class QueryAnalyzer(object):
     """
 
     # Note: the last few formatting characters are extra, from us.
-    re_fmt = '[#0 +-]?([0-9]+|\\*)?(\\.[0-9]*)?[hlL]?[diouxXeEfFgGcrsSAO]'
+    re_fmt = '[#0 +-]?(?:[0-9]+|\\*)?(?:\\.[0-9]*)?[hlL]?[diouxXeEfFgGcrsSAO]'
 
-    regexp = re.compile('%%(\\(([a-zA-Z0-9_]+)\\))?(%s)' % re_fmt)
+    # Only the key name and the format are captured (see analyze()).
+    regexp = re.compile('%%(?:\\(([a-zA-Z0-9_]+)\\))?(%s)' % re_fmt)
 
     def __init__(self, query, paramstyle=None):
         self.orig_query = query
@@ -161,6 +163,14 @@ class QueryAnalyzer(object):
 
         self.analyze() # Initialize.
 
+    def __getstate__(self):
+        # The analysis (including the generated function) is redone on
+        # unpickling.
+        return (self.orig_query, self.paramstyle)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
     def init_style(self, paramstyle):
         "Pre-calculate style-specific constants."
         if paramstyle == 'pyformat':
@@ -191,30 +201,176 @@ class QueryAnalyzer(object):
 
         poscount = count(1)
 
+        # Split the query in literal strings and formatting specifiers (empty
+        # strings are skipped).  The split interleaves the literal strings with
+        # the values of all the groups of each match, which avoids creating
+        # match objects.
         comps = self.components = []
-        for x in gensplit(self.regexp, query):
-            if isinstance(x, (str, unicode)):
-                comps.append(x)
+        parts = self.regexp.split(query)
+        step = self.regexp.groups + 1
+        for i in xrange(0, len(parts) - 1, step):
+            if parts[i]:
+                comps.append(parts[i])
+
+            keyname, fmt = parts[i + 1], parts[i + 2]
+            if keyname is None:
+                keyname = '__p%d' % next(poscount)
+                self.positional.append(keyname)
+            sep = ', '
+            if fmt in 'XS':
+                fmt = 's'
+                escaped = True
+            elif fmt in 'A':
+                fmt = 's'
+                escaped = True
+                sep = ' AND '
+            elif fmt in 'O':
+                fmt = 's'
+                escaped = True
+                sep = ' OR '
             else:
-                keyname, fmt = x.group(2, 3)
-                if keyname is None:
-                    keyname = '__p%d' % _next(poscount)
-                    self.positional.append(keyname)
-                sep = ', '
-                if fmt in 'XS':
-                    fmt = 's'
-                    escaped = True
-                elif fmt in 'A':
-                    fmt = 's'
-                    escaped = True
-                    sep = ' AND '
-                elif fmt in 'O':
-                    fmt = 's'
-                    escaped = True
-                    sep = ' OR '
+                escaped = False
+            comps.append( (keyname, escaped, sep, fmt) )
+        if parts[-1]:
+            comps.append(parts[-1])
+
+        self._compile()
+
+    def _compile(self):
+        """
+        Generate the function used to apply the arguments when none of them are
+        lists, sets or dicts (the common case).  All the formatting specifiers
+        can then be laid out in advance, and the generated function only has to
+        pick the arguments and build the query.  Some rare formats cannot be
+        compiled (e.g. '*' widths), in which case _apply_fast is None.
+
+        The query is built by concatenating the literal strings with the
+        individually converted values, which avoids parsing the whole
+        template on every formatting; if the literal strings cannot be
+        formatted on their own (e.g. a stray '%'), the template is formatted
+        instead, to fail as usual.
+
+        The formatted query only depends on the unescaped arguments (the
+        escaped ones are left to the DBAPI), so it is cached on their values
+        and types, for the common case where e.g. a table name is constant and
+        only escaped values change between calls.  Only integers and strings
+        are cached: other values may compare equal and still be formatted
+        differently (e.g. 0.0 and -0.0, or Decimal('1.0') and Decimal('1.00')).
+
+        A query without any formatting specifiers is formatted right away, in
+        _constant_query, so that execute() and execute_f() can bypass the
+        application.
+        """
+        self._apply_fast = self._constant_query = None
+
+        style_fmt = self.style_fmt
+        no = count(1)
+        varnames = {}
+        fetch, template, values, delayed = [], [], [], []
+        pieces = [] # Literal strings, and variables with their format.
+        for x in self.components:
+            if isinstance(x, (str, unicode)):
+                template.append(x)
+                pieces.append(x)
+                continue
+
+            keyname, escaped, sep, fmt = x
+            if '*' in fmt:
+                return
+            try:
+                var = varnames[keyname]
+            except KeyError:
+                var = varnames[keyname] = '_v%d' % len(varnames)
+                if keyname in self.positional:
+                    source = 'args[%d]' % self.positional.index(keyname)
                 else:
-                    escaped = False
-                comps.append( (keyname, escaped, sep, fmt) )
+                    source = 'kwds[%r]' % keyname
+                fetch.append('    %s = %s\n'
+                             '    if isinstance(%s, _nonscalar):\n'
+                             '        return None\n' % (var, source, var))
+
+            if escaped:
+                template.append(style_fmt % {'name': keyname, 'no': next(no)})
+                pieces.append(template[-1])
+                if self.style_argstype is list:
+                    delayed.append(var)
+                elif (keyname, var) not in delayed:
+                    delayed.append((keyname, var))
+            else:
+                template.append('%' + fmt)
+                pieces.append((var, template[-1]))
+                values.append(var)
+
+        if self.style_argstype is list:
+            delayed = '[%s]' % ', '.join(delayed)
+        else:
+            delayed = '{%s}' % ', '.join('%r: %s' % x for x in delayed)
+
+        try:
+            build = self._concat_expr(pieces)
+        except (TypeError, ValueError):
+            build = '_template %% (%s)' % ''.join('%s, ' % var
+                                                  for var in values)
+
+        source = ['def _apply_fast(args, kwds):\n']
+        source.extend(fetch)
+        keyvars = sorted(set(values))
+        source.append(
+            '    if %s:\n'
+            '        key = (%s)\n'
+            '        try:\n'
+            '            query = _queries[key]\n'
+            '        except KeyError:\n'
+            '            if len(_queries) >= _queries_max:\n'
+            '                _queries.clear()\n'
+            '            query = _queries[key] = %s\n'
+            '    else:\n'
+            '        query = %s\n'
+            '    return query, %s\n' % (
+                ' and '.join('%s.__class__ in _cacheable' % var
+                             for var in keyvars) or 'True',
+                ''.join('%s, %s.__class__, ' % (var, var) for var in keyvars),
+                build, build, delayed))
+
+        namespace = {'_template': ''.join(template),
+                     '_nonscalar': (tuple, list, set, dict),
+                     '_cacheable': frozenset((int, long, str, unicode)),
+                     '_queries': {},
+                     '_queries_max': 64}
+        exec(''.join(source), namespace)
+        self._apply_fast = namespace['_apply_fast']
+
+        if not varnames:
+            try:
+                self._constant_query = namespace['_template'] % ()
+            except (TypeError, ValueError):
+                pass # Let the errors occur at application time.
+
+    @staticmethod
+    def _concat_expr(pieces):
+        """
+        Return the source of an expression that concatenates the given literal
+        strings and (variable, format) pairs.  Raises TypeError or ValueError
+        if the literal strings do not format on their own.
+        """
+        exprs, literal = [], None
+        for x in pieces:
+            if isinstance(x, (str, unicode)):
+                x = x % () # Format on its own, e.g. '%%' to '%'.
+                literal = x if literal is None else literal + x
+                continue
+            if literal is not None:
+                exprs.append(repr(literal))
+                literal = None
+            var, fmt = x
+            if fmt == '%s' and str is unicode:
+                exprs.append('str(%s)' % var)
+            else:
+                # Python 2 promotes to unicode if necessary.
+                exprs.append('%r %% (%s,)' % (fmt, var))
+        if literal is not None:
+            exprs.append(repr(literal))
+        return "''.join((%s))" % ''.join('%s, ' % x for x in exprs)
 
     def __str__(self):
         """
@@ -222,37 +378,48 @@ class QueryAnalyzer(object):
         positional and keyword arguments.
         """
         style_fmt = self.style_fmt
-        oss = StringIO()
+        output = []
+        write = output.append
         no = count(1)
         for x in self.components:
             if isinstance(x, (str, unicode)):
-                oss.write(x)
+                write(x)
             else:
                 keyname, escaped, sep, fmt = x
                 if escaped:
-                    oss.write(style_fmt % {'name': keyname,
-                                           'no': _next(no)})
+                    write(style_fmt % {'name': keyname,
+                                       'no': next(no)})
                 else:
-                    oss.write('%%(%s)%s' % (keyname, fmt))
-        return oss.getvalue()
+                    write('%%(%s)%s' % (keyname, fmt))
+        return ''.join(output)
 
     def apply(self, *args, **kwds):
+        return self._apply(args, kwds)
+
+    def _apply(self, args, kwds):
         if len(args) != len(self.positional):
             raise TypeError('not enough arguments for format string')
 
+        if self._apply_fast is not None:
+            result = self._apply_fast(args, kwds)
+            if result is not None:
+                return result
+        return self._apply_generic(args, kwds)
+
+    def _apply_generic(self, args, kwds):
         # Merge the positional arguments in the keywords dict.
-        for name, value in izip(self.positional, args):
-            assert name not in kwds
-            kwds[name] = value
+        assert not (kwds and set(self.positional).intersection(kwds))
+        kwds.update(izip(self.positional, args))
 
         # Patch up the components into a string.
-        listexpans = {} # cached list expansions.
-        apply_kwds, delay_kwds = {}, self.style_argstype()
+        argstype = self.style_argstype
+        apply_kwds, delay_kwds = {}, argstype()
 
         no = count(1)
         style_fmt = self.style_fmt
         dict_fmt = '%%(key)s = %s' % style_fmt
         output = []
+        append = output.append
         for x in self.components:
             if isinstance(x, (str, unicode)):
                 out = x
@@ -263,19 +430,36 @@ class QueryAnalyzer(object):
                 # Expand into lists of words.
                 value = kwds[keyname]
                 if isinstance(value, (tuple, list, set)):
+                    if not escaped:
+                        # Format the elements right away, protecting the
+                        # result from the final formatting.
+                        elemfmt = '%' + fmt
+                        out = sep.join([elemfmt % (x,) for x in value])
+                        append(out.replace('%', '%%'))
+                        continue
+                    elif argstype is list:
+                        # Positional styles do not need the element names.
+                        delay_kwds.extend(value)
+                        append(sep.join([style_fmt % {'no': next(no)}
+                                         for x in value]))
+                        continue
+
+                    # The element names and their formatting only depend on
+                    # the length of the list, and are cached across calls.
+                    lkey = (keyname, len(value), style_fmt, sep)
                     try:
-                        words = listexpans[keyname] # Try cache.
+                        words, out = _list_expansions[lkey]
                     except KeyError:
-                        # Compute list expansion.
                         words = ['%s_l%d__' % (keyname, x)
                                  for x in xrange(len(value))]
-                        listexpans[keyname] = words
-
-                    if escaped:
-                        outfmt = [style_fmt %
-                                  {'name': x, 'no': _next(no)} for x in words]
-                    else:
-                        outfmt = ['%%(%s)%s' % (x, fmt) for x in words]
+                        out = sep.join([style_fmt % {'name': x}
+                                        for x in words])
+                        if len(_list_expansions) >= 1024:
+                            _list_expansions.clear()
+                        _list_expansions[lkey] = words, out
+                    delay_kwds.update(izip(words, value))
+                    append(out)
+                    continue
 
                 elif isinstance(value, dict):
                     # If a dict is passed in, the format specified *must* be for
@@ -294,7 +478,7 @@ class QueryAnalyzer(object):
                 else:
                     words, value = (keyname,), (value,)
                     if escaped:
-                        outfmt = [style_fmt % {'name': keyname, 'no': _next(no)}]
+                        outfmt = [style_fmt % {'name': keyname, 'no': next(no)}]
                     else:
                         outfmt = ['%%(%s)%s' % (keyname, fmt)]
 
@@ -304,7 +488,6 @@ class QueryAnalyzer(object):
                     okwds = apply_kwds
 
                 # Dispatch values on the appropriate output dictionary.
-                assert len(words) == len(value)
                 if isinstance(okwds, dict):
                     okwds.update(izip(words, value))
                 else:
@@ -313,7 +496,7 @@ class QueryAnalyzer(object):
                 # Create formatting string.
                 out = sep.join(outfmt)
 
-            output.append(out)
+            append(out)
 
         # Apply positional arguments, here, now.
         newquery = ''.join(output)
@@ -328,23 +511,39 @@ class QueryAnalyzer(object):
         and keywords.
         """
         # Translate this call into a compatible call to execute().
-        cquery, ckwds = self.apply(*args, **kwds)
+        if self._constant_query is not None and not args:
+            cquery, ckwds = self._constant_query, self.style_argstype()
+        else:
+            cquery, ckwds = self._apply(args, kwds)
 
         # Execute the transformed query.
         return cursor_.execute(cquery, ckwds)
 
+    def executemany(self, cursor_, seq_args, **kwds):
+        """
+        Execute the analyzed query on the given cursor once for each sequence
+        of positional arguments in 'seq_args', with the given keywords shared
+        by all of them.  Consecutive rows that translate into the same query
+        are passed together to the cursor's executemany().
+        """
+        apply_ = self._apply
+        lastquery, batch = None, []
+        for args in seq_args:
+            # Note: the generic application updates the keywords it is given.
+            cquery, ckwds = apply_(args, dict(kwds))
+            if cquery != lastquery:
+                if batch:
+                    cursor_.executemany(lastquery, batch)
+                lastquery, batch = cquery, []
+            batch.append(ckwds)
+        if batch:
+            cursor_.executemany(lastquery, batch)
+
 
-def gensplit(regexp, s):
-    """
-    Regexp-splitter generator.  Generates strings and match objects.
-    """
-    c = 0
-    for mo in regexp.finditer(s):
-        yield s[c:mo.start()]
-        yield mo
-        c = mo.end()
-    yield s[c:]
 
+# Cache of the escaped list expansions for the named parameter styles, keyed on
+# the key name, list length, style format and separator.
+_list_expansions = {}
 
 
 _def_paramstyle = 'pyformat'
@@ -372,8 +571,50 @@ Compile a query in a compatible query analyzer.
 
 
 # Query cache used to avoid having to analyze the same queries multiple times.
-# Hashed on the query string.
-_query_cache = {}
+# Hashed on the query string and the parameter style.  It is bounded, for
+# applications that build queries dynamically: the least recently used queries
+# are evicted (simply the oldest ones in Python 2, whose OrderedDict cannot
+# reorder entries cheaply).
+_query_cache = OrderedDict()
+_query_cache_max = 512
+_query_cache_touch = getattr(_query_cache, 'move_to_end', None)
+
+def set_cache_size(size):
+    """
+    Set the maximum number of analyzed queries kept by execute_f() (512 by
+    default), evicting the oldest ones if necessary.
+    """
+    global _query_cache_max
+    if size < 1:
+        raise ValueError("Invalid query cache size: %s" % size)
+    _query_cache_max = size
+    while len(_query_cache) > size:
+        _query_cache.popitem(last=False)
+
+def _cached_analyzer(key):
+    """
+    Return the cached query analyzer for the given (query, paramstyle) key,
+    analyzing the query if it is not in the cache.
+    """
+    try:
+        q = _query_cache[key]
+    except KeyError:
+        q = qcompile(*key)
+        try:
+            if len(_query_cache) >= _query_cache_max:
+                _query_cache.popitem(last=False)
+        except KeyError:
+            pass # Emptied by another thread.
+        # If another thread analyzed the same query meanwhile, use its
+        # analyzer.
+        q = _query_cache.setdefault(key, q)
+    else:
+        if _query_cache_touch is not None:
+            try:
+                _query_cache_touch(key)
+            except KeyError:
+                pass # Evicted by another thread.
+    return q
 
 # Note: we use cursor_ and query_ because we often call this function with
 # vars() which include those names on the caller side.
@@ -404,11 +645,13 @@ def execute_f(cursor_, query_, *args, **kwds):
 
     See qcompile() for details.
 
-    Note that this function accepts a '_paramstyle' optional argument, to set
-    which parameter style to use.
+    Note that this function accepts a 'paramstyle' optional argument, to set
+    which parameter style to use (the default one otherwise).
     """
-    debug = debug_convert or kwds.pop('__debug__', None)
-    if debug:
+    # Note: the debugging code is removed entirely when running with -O.
+    if __debug__:
+        debug = debug_convert or kwds.pop('__debug__', None)
+    if __debug__ and debug:
         print('\n' + '=' * 80)
         print('\noriginal =')
         print(query_)
@@ -418,20 +661,19 @@ def execute_f(cursor_, query_, *args, **kwds):
         pprint(kwds)
 
     # Get the cached query analyzer or create one.
-    try:
-        q = _query_cache[query_]
-    except KeyError:
-        _query_cache[query_] = q = qcompile(
-            query_,
-            paramstyle=kwds.pop('paramstyle', None))
+    q = _cached_analyzer(
+        (query_, kwds.pop('paramstyle', None) or _def_paramstyle))
 
-    if debug:
+    if __debug__ and debug:
         print('\nquery analyzer =', str(q))
 
     # Translate this call into a compatible call to execute().
-    cquery, ckwds = q.apply(*args, **kwds)
+    if q._constant_query is not None and not args:
+        cquery, ckwds = q._constant_query, q.style_argstype()
+    else:
+        cquery, ckwds = q._apply(args, kwds)
 
-    if debug:
+    if __debug__ and debug:
         print('\ntransformed =')
         print(cquery)
         print('\nnewkwds =')
@@ -441,6 +683,35 @@ def execute_f(cursor_, query_, *args, **kwds):
     return cursor_.execute(cquery, ckwds)
 
 
+def executemany_f(cursor_, query_, seq_args, **kwds):
+    """
+    Fancy executemany method for a cursor, the counterpart of execute_f() for
+    running a query once for each sequence of positional arguments in
+    'seq_args'.  The keyword arguments are shared by all the rows.  The query
+    is analyzed only once, and the rows are passed on to the cursor's
+    executemany(), in batches of consecutive rows that translate to the same
+    query (e.g. rows whose unescaped arguments differ are run separately).
+    """
+    q = _cached_analyzer(
+        (query_, kwds.pop('paramstyle', None) or _def_paramstyle))
+    return q.executemany(cursor_, seq_args, **kwds)
+
+
+def warmup(queries, paramstyle=None):
+    """
+    Analyze the given queries ahead of time into the cache used by execute_f(),
+    e.g. before forking worker processes, which will then inherit the
+    analyzers instead of each redoing the analysis.
+    """
+    for query in queries:
+        key = (query, paramstyle or _def_paramstyle)
+        if key in _query_cache:
+            continue
+        if len(_query_cache) >= _query_cache_max:
+            _query_cache.popitem(last=False)
+        _query_cache[key] = qcompile(*key)
+
+
 # Add support for ntuple wrapping (std in 2.6).
 try:
     from collections import namedtuple
@@ -538,7 +809,7 @@ class _TestCursor(object):
 
         result = query % kwds
 
-        if debug_convert:
+        if __debug__ and debug_convert:
             print('\n--- 5. after full replacement (fake dbapi application)')
             print(result)
 
@@ -756,6 +1027,92 @@ class TestExtension(unittest.TestCase):
                 print(qstr)
                 print(qargs)
 
+    def test_compiled(self):
+        "Tests that the compiled application matches the generic one."
+
+        query = ' %s %(k)d %S %(k)S %(f)5.1f 100%% %X '
+        args = ('simple', 'escaped', 'escaped2')
+        kwds = dict(k=42, f=3.14159)
+        for style in ('pyformat', 'named', 'qmark', 'format', 'numeric'):
+            qanal = qcompile(query, paramstyle=style)
+            self.assertTrue(qanal._apply_fast is not None)
+            self.assertEquals(qanal._apply_fast(args, kwds),
+                              qanal._apply_generic(args, dict(kwds)))
+
+        # Lists fall back on the generic application.
+        qanal = qcompile(' %s %S ')
+        self.assertEquals(qanal._apply_fast(([1, 2], 3), {}), None)
+        self.assertEquals(qanal.apply([1, 2], 3), (' 1, 2 %(__p2)s ',
+                                                   {'__p2': 3}))
+
+        # Values that compare equal but format differently are not confused.
+        qanal = qcompile(' SELECT %s FROM t WHERE x = %S ')
+        self.assertEquals(qanal.apply(0.0, 1)[0],
+                          ' SELECT 0.0 FROM t WHERE x = %(__p2)s ')
+        self.assertEquals(qanal.apply(-0.0, 1)[0],
+                          ' SELECT -0.0 FROM t WHERE x = %(__p2)s ')
+        self.assertEquals(qanal.apply(True, 1)[0],
+                          ' SELECT True FROM t WHERE x = %(__p2)s ')
+        self.assertEquals(qanal.apply(1, 1)[0],
+                          ' SELECT 1 FROM t WHERE x = %(__p2)s ')
+
+        # Queries without specifiers are formatted once.
+        qanal = qcompile(' COMMIT 100%% ')
+        self.assertEquals(qanal._constant_query, ' COMMIT 100% ')
+        cursor = _TestCursor()
+        cursor.execute = lambda query, args: (query, args)
+        self.assertEquals(qanal.execute(cursor), (' COMMIT 100% ', {}))
+
+    def test_pickle(self):
+        "Tests that analyzers survive pickling and that they can be cached."
+        import pickle
+
+        qanal = qcompile(' %s %(k)S ', paramstyle='qmark')
+        qanal2 = pickle.loads(pickle.dumps(qanal))
+        self.assertEquals(qanal2.paramstyle, 'qmark')
+        self.assertEquals(qanal2.positional, ['__p1'])
+        self.assertEquals(qanal2.apply('a', k='b'), qanal.apply('a', k='b'))
+
+        query = ' SELECT %s FROM warmup WHERE id = %S '
+        warmup([query])
+        self.assertTrue((query, _def_paramstyle) in _query_cache)
+        set_cache_size(1)
+        self.assertEquals(list(_query_cache), [(query, _def_paramstyle)])
+        set_cache_size(512)
+        self.compare_nows(_TestCursor().execute_f(query, 'name', 42),
+                          " SELECT name FROM warmup WHERE id = 42 ")
+
+    def test_executemany(self):
+        "Tests running a query for many rows of arguments."
+        calls = []
+        cursor = _TestCursor()
+        cursor.executemany = lambda query, seq: calls.append((query, seq))
+
+        rows = [('a', 1), ('a', 2), ('b', 3), ('a', 4)]
+        executemany_f(cursor, ' UPDATE %(t)s SET %s = %S ', rows, t='things')
+        self.assertEquals(calls, [
+            (' UPDATE things SET a = %(__p2)s ', [{'__p2': 1}, {'__p2': 2}]),
+            (' UPDATE things SET b = %(__p2)s ', [{'__p2': 3}]),
+            (' UPDATE things SET a = %(__p2)s ', [{'__p2': 4}])])
+
+        # Escaped lists go through the generic application.
+        del calls[:]
+        qanal = qcompile(' INSERT INTO things VALUES (%S) ',
+                         paramstyle='qmark')
+        qanal.executemany(cursor, [([1, 2],), ([3, 4],)])
+        self.assertEquals(calls, [(' INSERT INTO things VALUES (?, ?) ',
+                                   [[1, 2], [3, 4]])])
+
+    def test_paramstyle_cache(self):
+        "Tests that cached analyzers are not shared between styles."
+        cursor = _TestCursor()
+        cursor.execute = lambda query, args: (query, args)
+        query = ' SELECT %s WHERE id = %S '
+        self.assertEquals(cursor.execute_f(query, 'a', 1, paramstyle='qmark'),
+                          (' SELECT a WHERE id = ? ', [1]))
+        self.assertEquals(cursor.execute_f(query, 'a', 1, paramstyle='named'),
+                          (' SELECT a WHERE id = :__p2 ', {'__p2': 1}))
+
     def test_dict(self):
         "Tests for passing in a dictionary argument."
 
@@ -18,8 +18,8 @@ class O(object):
 
 o = O('R%', second='S%')
 
-print o[0]
-print o['second']
+print(o[0])
+print(o['second'])
 
 
 
@@ -41,6 +41,6 @@ cursor.execute("""
   """, o)
 
 for row in cursor:
-    print row
+    print(row)
 
 
@@ -341,6 +341,27 @@ class TestMorm(unittest.TestCase):
         self.assert_(isinstance(obj.religion, str))
         self.assert_(obj.religion == u'christian'.encode('latin-1'))
 
+        # Subclasses that only override to_python() are used for all rows.
+        class MormConvUpper(MormConvUnicode):
+            def to_python(self, vstr):
+                return MormConvUnicode.to_python(self, vstr).upper()
+
+        class UpperTable(TestTable):
+            converters = {'lastname': MormConvUpper()}
+
+        objs = UpperTable.select_all(conn, 'WHERE id = %s', (4,))
+        self.assert_(objs[0].lastname == u'DEPARDIEU')
+
+        class MormConvUpperString(MormConvString):
+            def to_python(self, vstr):
+                return vstr.upper()
+
+        class UpperStringTable(TestTable):
+            converters = {'lastname': MormConvUpperString('UTF-8')}
+
+        obj = UpperStringTable.get(conn, id=4)
+        self.assert_(obj.lastname == 'DEPARDIEU')
+
 
     def test_sequence(self):
         """
@@ -381,6 +402,11 @@ class TestMorm(unittest.TestCase):
 
         self.assert_(obj.lastname == 'Leblanc')
 
+        # No row is returned when nothing is inserted.
+        self.assert_(TestTable.create(conn, 'ON CONFLICT DO NOTHING',
+                                      id=obj.id, lastname=u'Leblanc') is None)
+        conn.commit()
+
         #======================================================================/
 
 
@@ -411,6 +437,242 @@ class TestMorm(unittest.TestCase):
             assert isinstance(o.firstname, unicode)
             assert isinstance(o.motto, unicode)
 
+    def test_select_ndarray(self):
+        """
+        Test selecting into a NumPy record array.
+        """
+        try:
+            import numpy
+        except ImportError:
+            return
+        conn = self.conn
+
+        arr = TestTable.select_ndarray(conn, cols=('id', 'test1.lastname'))
+        self.assert_(len(arr) == TestTable.count(conn))
+        self.assert_(arr.dtype.names == ('id', 'lastname'))
+
+        arr = TestTable.select_ndarray(conn, 'WHERE id = %s', (2843732,))
+        self.assert_(len(arr) == 0)
+
+    def test_insert_many(self):
+        """
+        Test inserting many rows at once.
+        """
+        conn = self.conn
+
+        nbrows = TestTable2.count(conn)
+
+        #======================================================================\
+
+        TestTable2.insert_many(conn,
+                               [dict(motto=u'Carpe diem'),
+                                dict(motto=u'Sapere aude'),
+                                dict(motto=u'Memento mori')])
+        conn.commit()
+
+        #======================================================================/
+
+        self.assert_(TestTable2.count(conn) == nbrows + 3)
+        self.assert_(TestTable2.insert_many(conn, []) is None)
+
+        self.assertRaises(MormError, TestTable2.insert_many, conn,
+                          [dict(motto=u'Carpe diem'), dict(id=100)])
+        self.assertRaises(MormError, TestTable2.insert_many, conn, [{}, {}])
+
+
+    def test_update_many(self):
+        """
+        Test updating many rows at once.
+        """
+        conn = self.conn
+
+        #======================================================================\
+
+        TestTable.update_many(conn,
+                              [(1, dict(lastname=u'Blais')),
+                               (2, dict(lastname=u'Binoche')),
+                               (2, dict(lastname=u'Depardieu')),
+                               (1, dict(religion='rock'))])
+        conn.commit()
+
+        #======================================================================/
+
+        obj = TestTable.get(conn, id=1)
+        self.assert_(obj.lastname == 'Blais' and obj.religion == 'rock')
+        obj = TestTable.get(conn, id=2)
+        self.assert_(obj.lastname == 'Depardieu')
+
+        self.assert_(TestTable.update_many(conn, []) is None)
+
+        # NULLs and strings for a column that is not text, and empty updates.
+        TestTable.update_many(conn, [(1, dict(creation=None)),
+                                     (2, dict(creation='2008-04-01')),
+                                     (2, {})])
+        conn.commit()
+        self.assert_(TestTable.get(conn, id=1).creation is None)
+        self.assert_(TestTable.get(conn, id=2).creation is not None)
+
+
+    def test_prepared(self):
+        """
+        Test inserting with server-side prepared statements.
+        """
+        conn = self.conn
+
+        class PreparedTable(TestTable):
+            use_prepared = True
+
+        nbrows = TestTable.count(conn)
+        for i in range(3):
+            PreparedTable.insert(conn,
+                                 firstname=u'Elvis',
+                                 lastname=u'Presley',
+                                 religion='rock')
+        conn.commit()
+
+        self.assert_(TestTable.count(conn) == nbrows + 3)
+
+        # Point lookups, twice to go through the already prepared statements.
+        o = next(TestTable.select(conn, 'WHERE religion = %s', ('rock',)))
+        for i in range(2):
+            p = PreparedTable.get(conn, id=o.id)
+            self.assert_(p.lastname == u'Presley')
+            p = PreparedTable.select_one(conn, 'WHERE id = %s', (o.id,))
+            self.assert_(p.id == o.id)
+
+        # Tuple arguments are expanded by the DBAPI, they are not prepared.
+        objs = PreparedTable.select_all(conn, 'WHERE id IN %s', ((o.id, -1),))
+        self.assert_([p.id for p in objs] == [o.id])
+
+        # Statements that cannot be prepared do not abort the transaction.
+        p = PreparedTable.select_one(conn, 'WHERE id = %s OR %s IS NULL',
+                                     (o.id, 1))
+        self.assert_(p.id == o.id)
+        self.assert_(PreparedTable.get(conn, id=o.id).id == o.id)
+
+        # Only the most recently used statements are kept prepared.
+        import antiorm
+        for i in range(antiorm._prepared_max + 1):
+            p = PreparedTable.select_one(conn, 'WHERE id = %%s AND %d = %d'
+                                         % (i, i), (o.id,))
+            self.assert_(p.id == o.id)
+        statements = antiorm._prepared[conn][0]
+        self.assert_(len(statements) == antiorm._prepared_max)
+        conn.commit()
+
+
+    def test_row_slots(self):
+        """
+        Test decoding into objects with slots.
+        """
+        conn = self.conn
+
+        class SlotsTable(TestTable):
+            objcls = MormRow
+
+        objs = SlotsTable.select_all(conn, cols=('id', 'lastname'))
+        self.assert_(objs)
+        for obj in objs:
+            self.assert_(isinstance(obj, MormRow))
+            self.assert_(not hasattr(obj, '__dict__'))
+            self.assert_(obj.id is not None)
+
+        obj = SlotsTable.get(conn, id=objs[0].id)
+        self.assert_(obj.lastname == objs[0].lastname)
+
+        # Column names that cannot be slots fall back on MormObject.
+        obj = next(SlotsTable.execute(conn, 'SELECT 1 + 1'))
+        self.assert_(isinstance(obj, MormObject))
+        self.assert_(getattr(obj, '?column?') == 2)
+
+
+    def test_insert_buffer(self):
+        """
+        Test buffering single-row inserts.
+        """
+        conn = self.conn
+
+        nbrows = TestTable2.count(conn)
+
+        #======================================================================\
+
+        buf = MormInsertBuffer(conn, maxrows=2)
+        for motto in (u'Festina lente', u'Alea jacta est', u'Veni vidi vici'):
+            buf.insert(TestTable2, motto=motto)
+        buf.commit()
+
+        #======================================================================/
+
+        self.assert_(TestTable2.count(conn) == nbrows + 3)
+
+
+    def test_copy_from(self):
+        """
+        Test inserting many rows with COPY.
+        """
+        conn = self.conn
+
+        nbrows = TestTable2.count(conn)
+
+        #======================================================================\
+
+        TestTable2.copy_from(conn,
+                             (dict(motto=x) for x in (u'Ora et labora',
+                                                      u'Say "cheese", ok?',
+                                                      u'',
+                                                      None)))
+        conn.commit()
+
+        #======================================================================/
+
+        self.assert_(TestTable2.count(conn) == nbrows + 4)
+        self.assert_(TestTable2.count(conn, 'WHERE motto IS NULL') >= 1)
+        self.assert_(TestTable2.select_one(
+            conn, 'WHERE motto = %s', (u'Say "cheese", ok?',)) is not None)
+
+
+    def test_copy_values(self):
+        """
+        Test rendering the values of various types for COPY.
+        """
+        import antiorm
+        line = antiorm._csv_line
+
+        self.assert_(line([bytearray(b'\x00\xff'), dbapi.Binary(b'ab')]) ==
+                     '"\\x00ff","\\x6162"\n')
+        self.assert_(line([[1, None, u'a"b\\c']]) ==
+                     '"{""1"",NULL,""a\\""b\\\\c""}"\n')
+        self.assert_(line([[[1, 2], [3, 4]]]) ==
+                     '"{{""1"",""2""},{""3"",""4""}}"\n')
+
+        # Unicode mixes with encoded strings.
+        line([u'Marit\xe9', 'santer\xeda'])
+
+        self.assertRaises(MormError, line, [{'motto': 'Carpe diem'}])
+
+
+    def test_select_stream(self):
+        """
+        Test selecting with a server-side cursor.
+        """
+        conn = self.conn
+
+        nbrows = TestTable.count(conn)
+        objs = list(TestTable.select(conn, stream=True))
+        self.assert_(len(objs) == nbrows)
+        for obj in objs:
+            self.assert_(isinstance(obj.firstname, unicode))
+
+        # Fetch in small batches.
+        objs = list(TestTable.select(conn, stream=True, prefetch=2))
+        self.assert_(len(objs) == nbrows)
+        objs = list(TestTable.select(conn, prefetch=2))
+        self.assert_(len(objs) == nbrows)
+
+        it = TestTable.select(conn, 'WHERE id = %s', (2843732,), stream=True)
+        self.assertRaises(StopIteration, it.next)
+        conn.commit()
+
 
 def suite():
     thesuite = unittest.TestSuite()
@@ -425,6 +687,15 @@ def suite():
     thesuite.addTest(TestMorm("test_conversions"))
     thesuite.addTest(TestMorm("test_sequence"))
     thesuite.addTest(TestMorm("test_create"))
+    thesuite.addTest(TestMorm("test_insert_many"))
+    thesuite.addTest(TestMorm("test_update_many"))
+    thesuite.addTest(TestMorm("test_select_ndarray"))
+    thesuite.addTest(TestMorm("test_prepared"))
+    thesuite.addTest(TestMorm("test_row_slots"))
+    thesuite.addTest(TestMorm("test_insert_buffer"))
+    thesuite.addTest(TestMorm("test_copy_from"))
+    thesuite.addTest(TestMorm("test_copy_values"))
+    thesuite.addTest(TestMorm("test_select_stream"))
     return thesuite
 
 if __name__ == '__main__':
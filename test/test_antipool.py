@@ -7,11 +7,21 @@ Tests for connection pool.
 
 # stdlib imports
 import threading
-from datetime import datetime, timedelta
+import weakref
+from itertools import count
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic # Python 2
 
 # antiorm imports
 from antipool import *
 
+try:
+    from psycopg2.extras import execute_values
+except ImportError:
+    execute_values = None # Only needed for --batch-size.
+
 
 
 names = ('martin', 'cyriaque', 'pierre', 'mathieu', 'marie-claude', 'eric'
@@ -22,39 +32,98 @@ class ConnectionPoolPoser(ConnectionPool):
     A fake pool of database connections, that does not pool at all but that
     behaves as if it did.  We use this for implementing performance comparisons
     in the tests.
+
+    By default each thread reuses its own connections, so that the costs of
+    connecting and authenticating do not dominate the comparison; they are
+    closed on finalization.
     """
+    actually_close = False
+    """If true, really connect and close for every operation."""
+
+    def __init__(self, *args, **kwds):
+        ConnectionPool.__init__(self, *args, **kwds)
+        self._thread_conns = threading.local()
+        self._opened = []
+
+    def _get_thread_connection(self, read_only):
+        if self.actually_close:
+            return self._create_connection(read_only)
+        try:
+            conns = self._thread_conns.conns
+        except AttributeError:
+            conns = self._thread_conns.conns = {}
+        try:
+            conn = conns[read_only]
+        except KeyError:
+            conn = conns[read_only] = self._create_connection(read_only)
+            self._opened.append(conn)
+        return conn
+
     def _get_connection_ro(self):
-        return self._create_connection(True)
+        return self._get_thread_connection(True)
 
     def _get_connection(self):
-        return self._create_connection(False)
-        
+        return self._get_thread_connection(False)
+
     def _release_ro(self, conn):
-        self._close(conn)
-        
+        if self.actually_close:
+            self._close(conn)
+
     def _release(self, conn):
-        self._close(conn)
+        if self.actually_close:
+            self._close(conn)
+        else:
+            conn.rollback()
+
+    def finalize(self):
+        for conn in self._opened:
+            self._close(conn)
+        self._opened = []
+        self._thread_conns = threading.local()
+        ConnectionPool.finalize(self)
 
 
 class Stats(object):
     """
-    An object that has a lock on it that you can use for mut.ex.
+    Operation counters shared between the test threads.  Stepping an
+    itertools.count is atomic, so that the counters do not need a lock.
     """
     def __init__(self):
-        self._lock = threading.Lock()
-
-        self.ops_ro = 0
-        self.ops_rw = 0
+        self._ops_ro = count()
+        self._ops_rw = count()
 
     def inc_ops_ro(self):
-        self._lock.acquire()
-        self.ops_ro += 1
-        self._lock.release()
-        
+        next(self._ops_ro)
+
     def inc_ops_rw(self):
-        self._lock.acquire()
-        self.ops_rw += 1
-        self._lock.release()
+        next(self._ops_rw)
+
+    def ops_ro(self):
+        "Return the number of RO operations; call this only once, at the end."
+        return next(self._ops_ro)
+
+    def ops_rw(self):
+        "Return the number of RW operations; call this only once, at the end."
+        return next(self._ops_rw)
+
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+def prepare_insert(conn):
+    """
+    Prepare the INSERT statement of the test on the given connection wrapper,
+    once per underlying connection.
+    """
+    rawconn = conn._conn
+    with _prepared_lock:
+        if rawconn in _prepared:
+            return
+        _prepared[rawconn] = True
+    conn.cursor().execute("""
+      PREPARE insert_thing (text, text) AS
+        INSERT INTO things (name, thread) VALUES ($1, $2);
+      """)
+
 
 class TestThreads(threading.Thread):
 
@@ -64,48 +133,77 @@ class TestThreads(threading.Thread):
         self.opts = opts
         self.stats = stats
         self._stop = False
+        self._random = random.Random()
+        "A generator per thread, which does not share its state."
 
     def stop(self):
         self._stop = True
 
     def run(self):
-        timeout = (datetime.now() + timedelta(seconds=self.opts.timeout))
+        deadline = monotonic() + self.opts.timeout
+        uniform, random_ = self._random.uniform, self._random.random
+        choice, randint = self._random.choice, self._random.randint
+        sleep = time.sleep
 
-        while not self._stop and datetime.now() < timeout:
-            time.sleep(random.uniform(0, self.opts.time_wait))
+        batch = []
+        while not self._stop and monotonic() < deadline:
+            sleep(uniform(0, self.opts.time_wait))
 
             conn = None
             try:
-                if random.random() < self.opts.prob_ro:
+                if random_() < self.opts.prob_ro:
                     # Read-only operation.
                     conn = dbpool.connection_ro()
 
                     curs = conn.cursor()
                     curs.execute("""
                       SELECT name FROM things LIMIT %s;
-                      """ % random.randint(0, 5))
-                    dbpool._log('SELECT %s\n' % ','.join(
-                        map(lambda x: x[0], curs.fetchall())))
+                      """ % randint(0, 5))
+                    rows = curs.fetchall()
+                    if dbpool._debug:
+                        dbpool._log('SELECT %s\n' % ','.join(
+                            [x[0] for x in rows]))
                     self.stats.inc_ops_ro()
 
                 else:
-                    conn = dbpool.connection()
-
-                    curs = conn.cursor()
-                    things = (random.choice(names), self.getName())
-                    dbpool._log('INSERT %s\n' % (things,))
-                    curs.execute("""
-                      INSERT INTO things (name, thread) VALUEs (%s, %s);
-                      """, things)
-                    conn.commit()
-                    self.stats.inc_ops_rw()
+                    batch.append( (choice(names), self.getName()) )
+                    if len(batch) >= self.opts.batch_size:
+                        conn = dbpool.connection()
+                        self.insert(conn, batch)
+                        batch = []
 
             finally:
-                time.sleep(self.opts.time_hold)
-                if random.random() < self.opts.prob_forget:
+                sleep(self.opts.time_hold)
+                if random_() < self.opts.prob_forget:
                     if conn is not None:
                         conn.release()
 
+        # Insert what is left of the last batch.
+        if batch:
+            conn = dbpool.connection()
+            try:
+                self.insert(conn, batch)
+            finally:
+                conn.release()
+
+    def insert(self, conn, batch):
+        """
+        Insert and commit a batch of things on the given connection.
+        """
+        curs = conn.cursor()
+        if dbpool._debug:
+            dbpool._log('INSERT %s\n' % (batch,))
+        if len(batch) == 1:
+            prepare_insert(conn)
+            curs.execute("EXECUTE insert_thing (%s, %s);", batch[0])
+        else:
+            execute_values(curs, """
+              INSERT INTO things (name, thread) VALUES %s;
+              """, batch)
+        conn.commit()
+        for things in batch:
+            self.stats.inc_ops_rw()
+
 
 def test():
     import optparse
@@ -145,6 +243,11 @@ def test():
                       "This will determine the resolution of the graph "
                       "generated.")
 
+    parser.add_option('--batch-size', action='store', type='int',
+                      default=1, metavar='N',
+                      help="Number of rows to insert at once in the RW "
+                      "operations.")
+
     parser.add_option('--minconn', action='store', type='int',
                       default=3,
                       help="Minimum number of connections to keep around when "
@@ -159,6 +262,14 @@ def test():
                       help="Default seconds to keep a connection for when "
                       "scaling down the pool.")
 
+    parser.add_option('--maxidle', action='store', type='float',
+                      default=None,
+                      help="Keep any connection idle for less than this many "
+                      "seconds, instead of using --minconn/--minkeepsecs.")
+
+    parser.add_option('--pruner', action='store_true',
+                      help="Scale down the pool from a background thread.")
+
     parser.add_option('--disable-ro', action='store_true',
                       help="Disable the read-only optimization.")
 
@@ -166,11 +277,18 @@ def test():
                       help="Do not really use connection pooling but rather "
                       "connect and close everytime.")
 
+    parser.add_option('--actually-close', action='store_true',
+                      help="With --poser, really connect and close for every "
+                      "operation, instead of reusing a connection per "
+                      "thread.")
+
     parser.add_option('--graph', '--generate-graph', action='store',
                       default=None, metavar='FILE', 
                       help="Generate a graph in the given filename.")
 
     opts, args = parser.parse_args()
+    if opts.batch_size > 1 and execute_values is None:
+        parser.error("--batch-size needs psycopg2.extras.execute_values().")
 
     if opts.graph:
         opts.graph = open(opts.graph, 'w')
@@ -178,12 +296,15 @@ def test():
     poolcls = ConnectionPool
     if opts.poser:
         poolcls = ConnectionPoolPoser
+        ConnectionPoolPoser.actually_close = opts.actually_close
     
     import psycopg2
     
     options=dict(minconn=opts.minconn,
                  maxconn=opts.maxconn,
                  minkeepsecs=opts.minkeepsecs,
+                 maxidle=opts.maxidle,
+                 pruner=opts.pruner,
                  disable_ro=opts.disable_ro,
                  debug=opts.debug and sys.stderr or None)
 
@@ -212,7 +333,7 @@ def test():
     up_and_down = 0
     if up_and_down:
         conns = []
-        for i in xrange(10):
+        for i in range(10):
             conns.append(dbpool.connection())
 
         for conn in conns:
@@ -222,40 +343,46 @@ def test():
 
     # Create threads that operate concurrently on that table.
     threads = []
-    for i in xrange(opts.threads):
+    for i in range(opts.threads):
         t = TestThreads(opts, stats)
         threads.append(t)
 
     # Start timer.
-    time_a = time.time()
+    time_a = monotonic()
 
     # Start threads.
     for t in threads:
         t.start()
     
+    # Accumulate the samples for the graph, written at the end.
+    samples = []
     try:
-        while time.time() - time_a < opts.timeout:
+        while monotonic() - time_a < opts.timeout:
             time.sleep(opts.time_stats)
             if opts.graph:
-                opts.graph.write('%d %d\n' % dbpool.getstats())
+                samples.append(dbpool.getstats())
     except KeyboardInterrupt:
-        print 'Interrupted.'
+        print('Interrupted.')
         for t in threads:
             t.stop()
 
     for t in threads:
         t.join()
 
-    time_b = time.time()
+    time_b = monotonic()
+
+    if opts.graph:
+        opts.graph.writelines(['%d %d\n' % x for x in samples])
+        opts.graph.close()
 
     dbpool.finalize()
 
     interval = time_b - time_a
-    print 'Options:'
-    for key, value in options.iteritems():
-        print '  %s: %s' % (key, value)
-    print ('Statistics:  %f RO ops/sec   %f RW ops/sec' % 
-           (float(stats.ops_ro)/interval, float(stats.ops_rw)/interval))
+    print('Options:')
+    for key, value in options.items():
+        print('  %s: %s' % (key, value))
+    print('Statistics:  %f RO ops/sec   %f RW ops/sec' % 
+          (float(stats.ops_ro())/interval, float(stats.ops_rw())/interval))
 
 
 test_drop = '''
@@ -6,6 +6,8 @@
 Tests for Anti-ORM.
 """
 
+from __future__ import print_function
+
 # stdlib imports
 import unittest
 
@@ -42,17 +44,17 @@ class TestPool(unittest.TestCase):
         Simple test.
         """
         
-        print '\nBEFORE'
+        print('\nBEFORE')
         for o in ConnOp(TestTable).select_all():
-            print o.firstname, o.lastname
+            print(o.firstname, o.lastname)
 
         ConnOp(TestTable).insert(firstname=u'Adriana',
                                  lastname=u'Sousa',
                                  religion='candombl')
 
-        print '\nAFTER'
+        print('\nAFTER')
         for o in ConnOp(TestTable).select_all():
-            print o.firstname, o.lastname
+            print(o.firstname, o.lastname)
 
 
 def suite():
@@ -59,9 +59,9 @@ def main():
 
 
     try:
-        for _ in xrange(2):
+        for _ in range(2):
             fork_party()
-    except Exception, e:
+    except Exception as e:
         trace('pid %s' % os.getpid())
         traceback.print_exc()
         traceback.print_exc(file=open('/tmp/out.%s' % os.getpid(), 'w'))